@@ -0,0 +1,549 @@
+from decimal import Decimal
+from datetime import date, timedelta
+from math import log, sqrt, erf
+from random import Random
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from contextlib import redirect_stdout, redirect_stderr
+from time import time, sleep, perf_counter
+import tracemalloc
+import io
+import json
+import argparse
+#Pretty columns for CLI display. pip install columnar
+from columnar import columnar
+from borrow_check import Queries, RateLimiter, PreparedChains, Calculations
+
+# constants
+BENCHMARK_API_KEY = 'Bearer benchmark' #The mock server doesn't check it, Queries just needs something to send.
+MOCK_RATELIMIT_ALLOWED = 1000000 #Calls per window the mock server hands out, high enough to never throttle.
+MOCK_RATELIMIT_WINDOW_SECONDS = 60
+#Timed scenarios. Latency is seconds added to every mock server response.
+SCENARIOS = {
+    #Low float name with a short, wide chain.
+    'small': {
+        'symbols': 1,
+        'expirations': 8,
+        'strikes': 40,
+        'strike_step': 0.5,
+        'spread': 0.15,
+        'volatility': 1.2,
+        'latency': 0.02
+    },
+    #SPY/AAPL sized chain, lots of weeklies and tight markets.
+    'megacap': {
+        'symbols': 1,
+        'expirations': 30,
+        'strikes': 300,
+        'strike_step': 1,
+        'spread': 0.02,
+        'volatility': 0.25,
+        'latency': 0.02
+    },
+    #Morning screener run.
+    'batch': {
+        'symbols': 200,
+        'expirations': 10,
+        'strikes': 40,
+        'strike_step': 1,
+        'spread': 0.1,
+        'volatility': 0.8,
+        'latency': 0.02
+    }
+}
+
+
+def normal_cdf(x: float) -> float:
+    return 0.5 * (1 + erf(x / sqrt(2)))
+
+def price_option(stock_price: float, strike: float, years: float, volatility: float, option_type: str) -> float:
+    """
+    Black-Scholes with no rates or dividends. Close enough to give the chains a realistic shape.
+    """
+    if years <= 0:
+        return max(stock_price - strike, 0) if option_type == 'call' else max(strike - stock_price, 0)
+    deviation = volatility * sqrt(years)
+    d1 = (log(stock_price / strike) + deviation ** 2 / 2) / deviation
+    d2 = d1 - deviation
+    call = stock_price * normal_cdf(d1) - strike * normal_cdf(d2)
+    return call if option_type == 'call' else call - stock_price + strike
+
+
+class SyntheticMarket(object):
+    """
+    Deterministic stand-in for Tradier market data. The same symbols, seed and settings always produce the same
+    payloads, in the exact JSON shape the quotes, expirations and chains endpoints return.
+    Expirations are weekly Fridays counted from today, so days remaining line up with what the calculations expect.
+    """
+    def __init__(
+        self,
+        symbols: int = 1,
+        expirations: int = 8,
+        strikes: int = 40,
+        strike_step: float = 1,
+        spread: float = 0.1,
+        volatility: float = 0.5,
+        seed: int = 0
+    ):
+        self.expiration_count = expirations
+        self.strike_count = strikes
+        self.strike_step = strike_step
+        self.spread = spread
+        self.volatility = volatility
+        self.seed = seed
+        self.today = date.today()
+        
+        rnd = Random('{0} prices'.format(seed))
+        self.prices = {}
+        for symbol_index in range(symbols):
+            self.prices['BM{0:03d}'.format(symbol_index)] = round(rnd.uniform(5, 500), 2)
+        self.symbols = list(self.prices.keys())
+    
+    def quote(self, symbol: str) -> dict:
+        price = self.prices[symbol]
+        return {
+            'symbol': symbol,
+            'description': '{0} Synthetic Inc'.format(symbol),
+            'exch': 'Q',
+            'type': 'stock',
+            'last': price,
+            'change': 0.0,
+            'volume': 1000000,
+            'open': price,
+            'high': price,
+            'low': price,
+            'close': None,
+            'bid': round(price - 0.01, 2),
+            'ask': price,
+            'change_percentage': 0.0,
+            'average_volume': 1000000,
+            'last_volume': 100,
+            'trade_date': 1700000000000,
+            'prevclose': price,
+            'week_52_high': round(price * 1.5, 2),
+            'week_52_low': round(price * 0.5, 2),
+            'bidsize': 1,
+            'bidexch': 'Q',
+            'bid_date': 1700000000000,
+            'asksize': 1,
+            'askexch': 'Q',
+            'ask_date': 1700000000000,
+            'root_symbols': symbol
+        }
+    
+    def quotes_response(self, symbols: list) -> dict:
+        """
+        Tradier returns a bare dict for a single match and lists unknown symbols separately.
+        """
+        quotes = [self.quote(symbol) for symbol in symbols if symbol in self.prices]
+        unmatched = [symbol for symbol in symbols if symbol not in self.prices]
+        response = {'quotes': {}}
+        if quotes:
+            response['quotes']['quote'] = quotes[0] if len(quotes) == 1 else quotes
+        if unmatched:
+            response['quotes']['unmatched_symbols'] = {'symbol': unmatched[0] if len(unmatched) == 1 else unmatched}
+        return response
+    
+    def expirations(self, symbol: str) -> list:
+        first_friday = self.today + timedelta(days=(4 - self.today.weekday()) % 7 or 7)
+        return [(first_friday + timedelta(weeks=week)).isoformat() for week in range(self.expiration_count)]
+    
+    def expirations_response(self, symbol: str) -> dict:
+        return {'expirations': {'date': self.expirations(symbol)}}
+    
+    def chain(self, symbol: str, expiration_date: str) -> list:
+        """
+        A call and a put per strike, centered on the stock price. Spread is the bid/ask width as a fraction of
+        the option price, with a penny minimum, so far OTM contracts end up with no bid like the real thing.
+        """
+        price = self.prices[symbol]
+        expiration = date.fromisoformat(expiration_date)
+        years = (expiration - self.today).days / 365
+        #Seeded by position rather than date so runs on different days see the same chains.
+        rnd = Random('{0} {1} {2}'.format(self.seed, symbol, self.expirations(symbol).index(expiration_date)))
+        first_strike = round(price / self.strike_step) * self.strike_step - self.strike_count // 2 * self.strike_step
+        
+        options = []
+        for strike_index in range(self.strike_count):
+            strike = round(first_strike + strike_index * self.strike_step, 2)
+            if strike <= 0:
+                continue
+            for option_type in ('call', 'put'):
+                mid = price_option(price, strike, years, self.volatility, option_type) * rnd.uniform(0.97, 1.03)
+                half_spread = max(mid * self.spread, 0.01) / 2
+                options.append({
+                    'symbol': '{0}{1}{2}{3:08d}'.format(symbol, expiration.strftime('%y%m%d'), option_type[0].upper(), int(round(strike * 1000))),
+                    'description': '{0} {1} ${2} {3}'.format(symbol, expiration_date, strike, option_type.title()),
+                    'exch': 'Z',
+                    'type': 'option',
+                    'last': round(mid, 2),
+                    'change': 0.0,
+                    'volume': rnd.randint(0, 5000),
+                    'open': None,
+                    'high': None,
+                    'low': None,
+                    'close': None,
+                    'bid': round(max(mid - half_spread, 0), 2),
+                    'ask': round(mid + half_spread, 2),
+                    'underlying': symbol,
+                    'strike': strike,
+                    'change_percentage': 0.0,
+                    'average_volume': 0,
+                    'last_volume': 1,
+                    'trade_date': 1700000000000,
+                    'prevclose': round(mid, 2),
+                    'week_52_high': 0.0,
+                    'week_52_low': 0.0,
+                    'bidsize': rnd.randint(1, 100),
+                    'bidexch': 'Q',
+                    'bid_date': 1700000000000,
+                    'asksize': rnd.randint(1, 100),
+                    'askexch': 'Q',
+                    'ask_date': 1700000000000,
+                    'open_interest': rnd.randint(0, 50000),
+                    'contract_size': 100,
+                    'expiration_date': expiration_date,
+                    'expiration_type': 'weeklys',
+                    'option_type': option_type,
+                    'root_symbol': symbol,
+                    'greeks': {
+                        'delta': 0.0,
+                        'gamma': 0.0,
+                        'theta': 0.0,
+                        'vega': 0.0,
+                        'rho': 0.0,
+                        'phi': 0.0,
+                        'bid_iv': self.volatility,
+                        'mid_iv': self.volatility,
+                        'ask_iv': self.volatility,
+                        'smv_vol': self.volatility,
+                        'updated_at': '{0} 20:00:00'.format(self.today.isoformat())
+                    }
+                })
+        return options
+    
+    def chain_response(self, symbol: str, expiration_date: str) -> dict:
+        return {'options': {'option': self.chain(symbol, expiration_date)}}
+    
+    def options_data(self, symbol: str) -> dict:
+        """
+        Same shape Queries.gather_data compiles, for timing the calculations without any fetching.
+        """
+        return {
+            'as_of': '{0}T09:30:00'.format(self.today.isoformat()),
+            'stock_quote': self.quote(symbol),
+            'options_data': [{expiration_date: self.chain(symbol, expiration_date)} for expiration_date in self.expirations(symbol)]
+        }
+
+
+class MockTradierServer(object):
+    """
+    Local HTTP stand-in for the Tradier endpoints Queries uses, serving a SyntheticMarket.
+    Every response waits latency seconds (plus up to jitter more) and carries the X-Ratelimit headers,
+    counting down from ratelimit_allowed per window. Once the budget is gone it answers 429 like Tradier does.
+    Use it as a context manager, point Queries at .url.
+    """
+    def __init__(
+        self,
+        market: SyntheticMarket,
+        latency: float = 0,
+        jitter: float = 0,
+        ratelimit_allowed: int = MOCK_RATELIMIT_ALLOWED,
+        ratelimit_window: float = MOCK_RATELIMIT_WINDOW_SECONDS,
+        seed: int = 0
+    ):
+        self.market = market
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit_allowed = ratelimit_allowed
+        self.ratelimit_window = ratelimit_window
+        self._rnd = Random(seed)
+        self._lock = Lock()
+        #Encoded payloads, built ahead of time by warm() so generating them isn't part of the timings.
+        self._payloads = {}
+        self.reset()
+        
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_GET(self):
+                mock._handle(self)
+            
+            def log_message(self, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+        self._thread = None
+    
+    def reset(self) -> None:
+        """
+        Zero the counters and start a fresh rate limit window.
+        """
+        with self._lock:
+            self.requests = 0
+            self.requests_by_endpoint = {}
+            self.bytes_sent = 0
+            self.ratelimit_used = 0
+            self.window_reset = time() + self.ratelimit_window
+    
+    def warm(self) -> None:
+        for symbol in self.market.symbols:
+            self._payload('/v1/markets/options/expirations', (symbol,))
+            for expiration_date in self.market.expirations(symbol):
+                self._payload('/v1/markets/options/chains', (symbol, expiration_date))
+    
+    def _payload(self, path: str, key: tuple) -> bytes:
+        cache_key = (path,) + key
+        payload = self._payloads.get(cache_key)
+        if payload is None:
+            if path == '/v1/markets/quotes':
+                data = self.market.quotes_response(list(key))
+            elif path == '/v1/markets/options/expirations':
+                data = self.market.expirations_response(key[0])
+            else:
+                data = self.market.chain_response(key[0], key[1])
+            payload = json.dumps(data).encode()
+            self._payloads[cache_key] = payload
+        return payload
+    
+    def _ratelimit_headers(self) -> tuple:
+        """
+        Take a call from the budget. Returns (status code, headers).
+        """
+        with self._lock:
+            now = time()
+            if now >= self.window_reset:
+                self.ratelimit_used = 0
+                self.window_reset = now + self.ratelimit_window
+            self.ratelimit_used += 1
+            status = 200 if self.ratelimit_used <= self.ratelimit_allowed else 429
+            return (status, {
+                'X-Ratelimit-Allowed': str(self.ratelimit_allowed),
+                'X-Ratelimit-Used': str(min(self.ratelimit_used, self.ratelimit_allowed)),
+                'X-Ratelimit-Available': str(max(self.ratelimit_allowed - self.ratelimit_used, 0)),
+                'X-Ratelimit-Expiry': str(int(self.window_reset * 1000))
+            })
+    
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        url = urlparse(request.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        delay = self.latency + (self._rnd.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            sleep(delay)
+        
+        status, headers = self._ratelimit_headers()
+        try:
+            if status == 429:
+                payload = b'Quota Violation'
+            elif url.path == '/v1/markets/quotes':
+                payload = self._payload(url.path, tuple(params['symbols'].split(',')))
+            elif url.path == '/v1/markets/options/expirations':
+                payload = self._payload(url.path, (params['symbol'],))
+            elif url.path == '/v1/markets/options/chains':
+                payload = self._payload(url.path, (params['symbol'], params['expiration']))
+            else:
+                status, payload = 404, b'Not Found'
+        except (KeyError, ValueError) as e:
+            status, payload = 400, 'Bad request: {0}'.format(e).encode()
+        
+        with self._lock:
+            self.requests += 1
+            self.requests_by_endpoint[url.path] = self.requests_by_endpoint.get(url.path, 0) + 1
+            self.bytes_sent += len(payload)
+        
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+    
+    def start(self) -> 'MockTradierServer':
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def __enter__(self) -> 'MockTradierServer':
+        return self.start()
+    
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+def run_scenario(market: SyntheticMarket, server: MockTradierServer, util: float = 0.9, borrow_rate: float = 0.5) -> dict:
+    """
+    One end to end pass: fetch every symbol from the mock server, then run both collar calculations.
+    Returns the phase timings and counts.
+    """
+    util = Decimal(str(util))
+    borrow_rate = Decimal(str(borrow_rate))
+    server.reset()
+    
+    queries_obj = Queries(market.symbols[0], BENCHMARK_API_KEY, api_url=server.url)
+    #Match the local budget to the mock server so the limiter only kicks in when a scenario asks for it.
+    queries_obj.rate_limiter = RateLimiter(calls_per_minute=server.ratelimit_allowed)
+    fetch_seconds = 0
+    calculate_seconds = 0
+    chains = 0
+    
+    #Quiet the progress bars and status prints, they'd swamp the report.
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        started = perf_counter()
+        if len(market.symbols) == 1:
+            gathered = [(market.symbols[0], queries_obj.gather_data())]
+        else:
+            gathered = queries_obj.gather_batch(market.symbols)
+        
+        fetch_started = started
+        for symbol, options_data in gathered:
+            calculate_started = perf_counter()
+            fetch_seconds += calculate_started - fetch_started
+            chains += len(options_data['options_data'])
+            calc_obj = Calculations()
+            prepared = PreparedChains(options_data)
+            calc_obj.calculate_symmetric_collar(prepared, util, borrow_rate)
+            calc_obj.calculate_asymmetric_collar(prepared, util, borrow_rate)
+            fetch_started = perf_counter()
+            calculate_seconds += fetch_started - calculate_started
+        fetch_seconds += perf_counter() - fetch_started
+        wall_seconds = perf_counter() - started
+    queries_obj.close()
+    
+    return {
+        'wall_seconds': wall_seconds,
+        'fetch_seconds': fetch_seconds,
+        'calculate_seconds': calculate_seconds,
+        'symbols': len(market.symbols),
+        'chains': chains,
+        'api_calls': server.requests,
+        'api_calls_by_endpoint': dict(server.requests_by_endpoint),
+        'bytes_downloaded': server.bytes_sent,
+        'ratelimit_available': queries_obj.ratelimit_available
+    }
+
+def benchmark(name: str, settings: dict, repeat: int = 3, measure_memory: bool = True) -> dict:
+    """
+    Time a scenario, keeping the best of repeat runs, then run it once more under tracemalloc for peak memory.
+    Memory is a separate pass since tracing slows everything down.
+    """
+    market = SyntheticMarket(
+        symbols=settings['symbols'],
+        expirations=settings['expirations'],
+        strikes=settings['strikes'],
+        strike_step=settings['strike_step'],
+        spread=settings['spread'],
+        volatility=settings['volatility']
+    )
+    with MockTradierServer(
+        market,
+        latency=settings['latency'],
+        jitter=settings.get('jitter', 0),
+        ratelimit_allowed=settings.get('ratelimit_allowed', MOCK_RATELIMIT_ALLOWED)
+    ) as server:
+        server.warm()
+        runs = [run_scenario(market, server) for _ in range(repeat)]
+        result = min(runs, key=lambda run: run['wall_seconds'])
+        
+        result['peak_memory_bytes'] = None
+        if measure_memory:
+            tracemalloc.start()
+            run_scenario(market, server)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    
+    result['scenario'] = name
+    result['settings'] = settings
+    result['repeat'] = repeat
+    result['calls_per_second'] = result['api_calls'] / result['fetch_seconds'] if result['fetch_seconds'] else None
+    result['chains_per_second'] = result['chains'] / result['wall_seconds'] if result['wall_seconds'] else None
+    return result
+
+def display_benchmarks(results: list, baseline: dict = None) -> None:
+    """
+    Print the scenario results, with the change in wall time against a saved baseline if there is one.
+    """
+    headers = ['scenario', 'wall', 'fetch', 'calc', 'calls', 'calls/s', 'chains/s', 'down', 'peak']
+    if baseline:
+        headers.append('change')
+    rows = []
+    for result in results:
+        row = [
+            result['scenario'],
+            '{0:.3f}s'.format(result['wall_seconds']),
+            '{0:.3f}s'.format(result['fetch_seconds']),
+            '{0:.3f}s'.format(result['calculate_seconds']),
+            result['api_calls'],
+            '{0:.1f}'.format(result['calls_per_second'] or 0),
+            '{0:.1f}'.format(result['chains_per_second'] or 0),
+            '{0:.1f}MB'.format(result['bytes_downloaded'] / 1e6),
+            '{0:.1f}MB'.format(result['peak_memory_bytes'] / 1e6) if result['peak_memory_bytes'] is not None else '-'
+        ]
+        if baseline:
+            previous = baseline.get(result['scenario'])
+            row.append('{0:+.1%}'.format(result['wall_seconds'] / previous['wall_seconds'] - 1) if previous else '-')
+        rows.append(row)
+    print(columnar(rows, headers, no_borders=True))
+
+def find_regressions(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Scenarios whose wall time grew by more than tolerance (0.1 = 10%) over the baseline.
+    """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if previous and result['wall_seconds'] > previous['wall_seconds'] * (1 + tolerance):
+            regressions.append(result['scenario'])
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fetching and calculating against a local mock Tradier server.')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run ({0}), defaults to all of them.'.format(', '.join(SCENARIOS.keys())))
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the fastest is reported.')
+    parser.add_argument('--latency', type=float, help='Override the per response latency of every scenario, in seconds.')
+    parser.add_argument('--jitter', type=float, help='Add up to this many random seconds to each response.')
+    parser.add_argument('--ratelimit', type=int, help='Calls per minute the mock server allows, to exercise throttling.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc pass.')
+    parser.add_argument('--output', help='Save the results as JSON, to use as a baseline later.')
+    parser.add_argument('--baseline', help='Compare against results saved with --output.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed wall time growth over the baseline before failing.')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario {0}.'.format(name))
+    
+    results = []
+    for name in args.scenarios or list(SCENARIOS.keys()):
+        settings = dict(SCENARIOS[name])
+        if args.latency is not None:
+            settings['latency'] = args.latency
+        if args.jitter is not None:
+            settings['jitter'] = args.jitter
+        if args.ratelimit is not None:
+            settings['ratelimit_allowed'] = args.ratelimit
+        print('Running {0} scenario.'.format(name))
+        results.append(benchmark(name, settings, repeat=args.repeat, measure_memory=not args.no_memory))
+    
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = {result['scenario']: result for result in json.load(baseline_file)}
+    display_benchmarks(results, baseline)
+    
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit('Slower than baseline: {0}'.format(', '.join(regressions)))
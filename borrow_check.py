@@ -1,16 +1,25 @@
 from decimal import Decimal
-from datetime import datetime, timedelta
-from math import ceil
-from os import getcwd
+from datetime import datetime, date, timedelta
+from math import ceil, isnan, nan
+from os import getcwd, replace
+import csv
+import json
+import argparse
+import struct
+import sys
+from array import array
 from pathlib import Path
-from collections import OrderedDict, defaultdict
-import requests
-#For progress bar in CLI. pip install tqdm
-import tqdm
-#Pretty columns for CLI display. pip install columnar
-from columnar import columnar
-#CLI colors. pip install click
-from click import style
+from collections import defaultdict
+from functools import lru_cache
+from heapq import heappush, heappop, heapreplace
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from threading import Condition, Lock
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from time import time, sleep, perf_counter
+from random import uniform
+#Third party imports are done where they're used, so importing this as a library or a cron run stays fast.
+#requests for the Tradier API, pip install requests. Display libraries only load when something gets displayed:
+#columnar for tables, tqdm for progress bars and click for colors, the last two only on a terminal. pip install tqdm columnar click
 
 # constants
 OPTION_CONTRACT_COST = 1 #Assuming a one-lot contract, $1 minimum. Conservative estimate.
@@ -18,22 +27,110 @@ CONTRACT_ACTIONS_PER_COLLAR = 4 #Number of contract actions required to manage a
 LOAN_ADJUSTED_RATE = Decimal(253 / 365) #Fee rate is calculated in annual APR, but is only paid out on trading days.
 IBKR_FEE_SPLIT = Decimal(0.5) #Interactive Brokers pays you 50% of the rate.
 OPTION_CONTRACT_SIZE = 100 #Nobody trades fractional lots anymore, do they?
+TRADIER_API_URL = 'https://sandbox.tradier.com'
+RATELIMIT_CALLS_PER_MINUTE = 120 #Tradier market data budget per rolling minute.
+RATELIMIT_RESERVE = 5 #Calls held back so a scan never drains the budget to zero.
+RATELIMIT_WINDOW_SECONDS = 60
+HTTP_TIMEOUT = (3.05, 15) #Connect and read timeouts in seconds, so one hung socket can't stall a scan.
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5 #Seconds, doubled per retry.
+HTTP_BACKOFF_CAP = 30
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+QUOTES_PER_REQUEST = 100 #Symbols per batched quote call, keeps the query string a sane length.
+CACHE_DIRECTORY = '.chain_cache'
+CACHE_TTL_SECONDS = 300
+WATCH_EXPIRATIONS_SECONDS = 3600 #How often watch mode re-lists expirations, they rarely change intraday.
+#Watch mode chain refresh interval as a multiple of the poll interval, by days remaining. Longer dated chains move less.
+WATCH_REFRESH_TIERS = ((7, 1), (30, 2), (90, 4))
+WATCH_REFRESH_TIER_MAX = 8
+#Fraction the stock ask has to move before watch mode re-ranks every held chain at the new price. Smaller moves
+#only re-rank chains that changed, at the price the rest were ranked at, so live asks don't recompute everything.
+WATCH_REPRICE_THRESHOLD = Decimal('0.001')
+TOP_K = 5 #Trades kept per ranking.
+#Columns of a trade record, in display order.
+TRADE_FIELDS = (
+    'days_to_profit',
+    'annualized_play_performance',
+    'breakeven_borrow_rate',
+    'call_moneyness',
+    'estimated_payout',
+    'cost_of_trade_per_day',
+    'expiration_net',
+    'strike',
+    'expiration_date',
+    'profitable'
+)
+#(field, highest is best) per ranking. Lowest risk by breakeven days, then max profit by estimated payout.
+RANKINGS = (('days_to_profit', False), ('estimated_payout', True))
+#Rankings that only get better as a collar's expiration net goes up. When every ranking is one of these,
+#the asymmetric search walks pairs best first and stops at the first pair no ranking wants.
+NET_MONOTONE_RANKINGS = (
+    ('days_to_profit', False),
+    ('annualized_play_performance', True),
+    ('breakeven_borrow_rate', False),
+    ('estimated_payout', True),
+    ('cost_of_trade_per_day', False),
+    ('expiration_net', True)
+)
+#Upper bounds in seconds of the latency histogram buckets in the run report.
+REPORT_HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REPORT_PROFILE_FUNCTIONS = 25 #Slowest functions by cumulative time included in the run report.
+#Typed columns of a TradeTable as (name, array typecode). Mirrors TRADE_FIELDS, except moneyness is an itm flag,
+#asymmetric collars put their put strike in its own column (NaN for symmetric ones) and expiration dates are
+#days since 1970-01-01.
+TRADE_COLUMNS = (
+    ('days_to_profit', 'q'),
+    ('annualized_play_performance', 'd'),
+    ('breakeven_borrow_rate', 'd'),
+    ('call_itm', 'b'),
+    ('estimated_payout', 'd'),
+    ('cost_of_trade_per_day', 'd'),
+    ('expiration_net', 'd'),
+    ('strike', 'd'),
+    ('put_strike', 'd'),
+    ('expiration_date', 'i'),
+    ('profitable', 'b')
+)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+COLUMNAR_MAGIC = b'EBCOLS1\n' #First bytes of a binary columnar trade export.
 
-def input_section() -> dict:
+def input_section(ask_symbol: bool = True) -> dict:
     """
     Inputs, defaults to str unless converted.
     """
     input_data = {}
-    input_data['symbol'] = input('Stock symbol:> ').upper().replace(' ','').replace('$', '')
+    if ask_symbol:
+        input_data['symbol'] = input('Stock symbol:> ').upper().replace(' ','').replace('$', '')
     input_data['util'] = Decimal(input('Utilization rate:> ')) / 100 #Inputted as percentage.
     input_data['borrow_rate'] = Decimal(input('Current borrow rate percentage:> ')) / 100 #Inputted as percentage.
     return input_data
 
+def batch_input_section(batch_file: str) -> list:
+    """
+    Batch inputs from a screener file. One symbol,util,borrow_rate row per line, rates as percentages.
+    Blank lines, comments starting with # and a header row are skipped.
+    """
+    batch_data = []
+    with open(batch_file, 'r', newline='') as screener_file:
+        for row in csv.reader(screener_file):
+            if not row or not row[0].strip() or row[0].strip().startswith('#') or row[0].strip().lower() == 'symbol':
+                continue
+            batch_data.append({
+                'symbol': row[0].upper().replace(' ','').replace('$', ''),
+                'util': Decimal(row[1].strip()) / 100,
+                'borrow_rate': Decimal(row[2].strip()) / 100
+            })
+    return batch_data
+
 
 class MissingAPIKeyException(Exception):
     pass
 
 
+class EngineValidationException(Exception):
+    pass
+
+
 def tradier_key() -> str:
     """
     Verifies and grabs Tradier key used to query the API.
@@ -54,343 +151,2283 @@ def tradier_key() -> str:
         else:
             raise MissingAPIKeyException('Problem with Tradier API key. Did not find correct format in key file.')
 
+@lru_cache(maxsize=None)
+def import_numpy():
+    """
+    numpy for the vectorized asymmetric engine, or None when it isn't installed. Optional, pip install numpy
+    Imported on first use since it's the slowest import by far.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def progress(iterable, total: int = None):
+    """
+    Wrap an iterable in a tqdm progress bar when there's a terminal to draw it on, otherwise leave it be.
+    """
+    if not sys.stderr.isatty():
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, total=total)
+
+
+class RateLimiter(object):
+    """
+    Thread safe throttle for the Tradier API budget.
+    Each call takes a slot from the budget before it goes out, and the budget is re-synced from the
+    X-Ratelimit-Available and X-Ratelimit-Expiry headers as responses come back. Once only the reserve
+    is left, callers queue until the window resets instead of running into 429s.
+    """
+    def __init__(self, calls_per_minute: int = RATELIMIT_CALLS_PER_MINUTE, reserve: int = RATELIMIT_RESERVE):
+        self.calls_per_minute = calls_per_minute
+        self.reserve = reserve
+        self.available = calls_per_minute
+        self.window_reset = time() + RATELIMIT_WINDOW_SECONDS
+        #Whether window_reset came from Tradier or is only a local guess.
+        self.window_from_server = False
+        self._condition = Condition()
+    
+    def _roll_window(self, now: float) -> None:
+        if now >= self.window_reset:
+            self.available = self.calls_per_minute
+            self.window_reset = now + RATELIMIT_WINDOW_SECONDS
+            self.window_from_server = False
+            self._condition.notify_all()
+    
+    def acquire(self) -> None:
+        """
+        Block until there is room in the budget, then take one call from it.
+        """
+        with self._condition:
+            while True:
+                now = time()
+                self._roll_window(now)
+                if self.available > self.reserve:
+                    self.available -= 1
+                    return
+                self._condition.wait(timeout=max(self.window_reset - now, 0.05))
+    
+    def update(self, headers: dict) -> None:
+        """
+        Sync the local budget with what Tradier reports. Within one window, calls still in flight were
+        already taken off locally, so the lower of the two counts wins. A later expiry means Tradier started
+        a new window, and its count replaces whatever was left of the old one. Late responses from an older
+        window are ignored, so the reset time only ever moves forward.
+        """
+        with self._condition:
+            now = time()
+            new_window = False
+            expiry = headers.get('X-Ratelimit-Expiry')
+            if expiry:
+                #Expiry is epoch milliseconds of when the current window resets.
+                window_reset = int(expiry) / 1000
+                if window_reset <= now or (self.window_from_server and window_reset < self.window_reset):
+                    self._roll_window(now)
+                    return
+                new_window = window_reset > self.window_reset
+                #A local guess gives way to Tradier's reset time, even an earlier one.
+                self.window_reset = window_reset
+                self.window_from_server = True
+            available = headers.get('X-Ratelimit-Available')
+            if new_window:
+                self.available = int(available) if available is not None else self.calls_per_minute
+                self._condition.notify_all()
+            elif available is not None:
+                self.available = min(self.available, int(available))
+            self._roll_window(now)
+
+
+class OfflineCacheMissException(Exception):
+    pass
+
+
+class ChainCache(object):
+    """
+    On-disk cache of Tradier responses, one JSON file per symbol and endpoint (and expiration for chains).
+    Entries older than the TTL are treated as missing. In offline mode the TTL is ignored and a miss raises
+    instead of falling through to the network.
+    """
+    def __init__(self, cache_dir: str = CACHE_DIRECTORY, ttl: float = CACHE_TTL_SECONDS, offline: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.offline = offline
+    
+    def _path(self, kind: str, symbol: str, expiration_date: str = None) -> Path:
+        file_name = '{0}_{1}.json'.format(kind, expiration_date) if expiration_date else '{0}.json'.format(kind)
+        return self.cache_dir / symbol / file_name
+    
+    def get(self, kind: str, symbol: str, expiration_date: str = None):
+        """
+        Cached data, or None if there is nothing fresh enough.
+        """
+        cache_file = self._path(kind, symbol, expiration_date)
+        try:
+            with open(cache_file, 'r') as cached:
+                entry = json.load(cached)
+        except (OSError, ValueError):
+            entry = None
+        
+        if entry is not None and (self.offline or time() - entry['fetched_at'] <= self.ttl):
+            return entry['data']
+        if self.offline:
+            raise OfflineCacheMissException('Offline mode and nothing cached for {0} {1}.'.format(symbol, cache_file.stem))
+        return None
+    
+    def put(self, kind: str, symbol: str, data, expiration_date: str = None) -> None:
+        cache_file = self._path(kind, symbol, expiration_date)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        #Write then rename so a reader on another thread never sees half a file.
+        temp_file = cache_file.with_suffix('.tmp')
+        with open(temp_file, 'w') as cached:
+            json.dump({'fetched_at': time(), 'data': data}, cached)
+        replace(temp_file, cache_file)
+
+
+def save_snapshot(options_data: dict, snapshot_file: str) -> None:
+    """
+    Save gathered data for a symbol so it can be replayed through the calculations later.
+    """
+    with open(snapshot_file, 'w') as snapshot:
+        json.dump(options_data, snapshot)
+
+def load_snapshot(snapshot_file: str) -> dict:
+    """
+    Load data saved with save_snapshot, same shape as Queries.gather_data returns.
+    """
+    with open(snapshot_file, 'r') as snapshot:
+        return json.load(snapshot)
+
+
+class RunReport(object):
+    """
+    Instrumentation for one run. Records stage timings for latency histograms, bytes downloaded, candidates
+    evaluated and API calls used against the remaining budget. Thread safe so every fetch worker can record
+    into the same report. to_dict() is the JSON run report.
+    Stages are 'fetch <endpoint>', 'ratelimit_wait', 'json_decode', 'chain_merge', 'symmetric', 'asymmetric' and 'render'.
+    """
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._started = perf_counter()
+        self._lock = Lock()
+        self.stage_timings = defaultdict(list)
+        self.fetch_by_expiration = defaultdict(dict)
+        self.counters = defaultdict(int)
+        self.bytes_downloaded = 0
+        self.ratelimit_allowed = None
+        self.ratelimit_available = None
+        self.profile_file = None
+        self.profile_top = None
+    
+    def __getstate__(self) -> dict:
+        #Locks don't pickle, and reports come back from process pool workers.
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = Lock()
+    
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_timings[stage].append(seconds)
+    
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Time the body of a with block as one sample of stage.
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - started)
+    
+    def count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+    
+    def record_response(self, path: str, seconds: float, response: 'requests.Response', available: int) -> None:
+        """
+        One API call went out and came back, successful or not.
+        """
+        allowed = response.headers.get('X-Ratelimit-Allowed')
+        with self._lock:
+            self.stage_timings['fetch {0}'.format(path)].append(seconds)
+            self.counters['api_calls'] += 1
+            self.bytes_downloaded += len(response.content)
+            if allowed is not None:
+                self.ratelimit_allowed = int(allowed)
+            self.ratelimit_available = available
+    
+    def record_expiration(self, symbol: str, expiration_date: str, seconds: float) -> None:
+        with self._lock:
+            self.fetch_by_expiration[symbol][expiration_date] = seconds
+    
+    def merge(self, other: 'RunReport') -> None:
+        """
+        Fold in the timings and counts of a report recorded elsewhere, e.g. in a process pool worker.
+        """
+        with self._lock:
+            for stage, timings in other.stage_timings.items():
+                self.stage_timings[stage].extend(timings)
+            for counter, amount in other.counters.items():
+                self.counters[counter] += amount
+    
+    def add_profile(self, profiler: 'cProfile.Profile', profile_file: str = None) -> None:
+        """
+        Keep the slowest functions by cumulative time from a finished profile.
+        """
+        import pstats
+        self.profile_file = profile_file
+        stats = pstats.Stats(profiler).stats
+        slowest = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:REPORT_PROFILE_FUNCTIONS]
+        self.profile_top = [{
+            'function': '{0}:{1}({2})'.format(*function),
+            'calls': calls,
+            'total_seconds': total_seconds,
+            'cumulative_seconds': cumulative_seconds
+        } for function, (_, calls, total_seconds, cumulative_seconds, _) in slowest]
+    
+    @staticmethod
+    def summarize(timings: list) -> dict:
+        """
+        Count, total, percentiles and a histogram of a list of durations in seconds.
+        """
+        ordered = sorted(timings)
+        histogram = {'<={0}s'.format(bound): 0 for bound in REPORT_HISTOGRAM_BUCKETS}
+        histogram['>{0}s'.format(REPORT_HISTOGRAM_BUCKETS[-1])] = 0
+        for seconds in ordered:
+            for bound in REPORT_HISTOGRAM_BUCKETS:
+                if seconds <= bound:
+                    histogram['<={0}s'.format(bound)] += 1
+                    break
+            else:
+                histogram['>{0}s'.format(REPORT_HISTOGRAM_BUCKETS[-1])] += 1
+        
+        def percentile(fraction: float) -> float:
+            return ordered[min(ceil(fraction * len(ordered)), len(ordered)) - 1]
+        
+        return {
+            'count': len(ordered),
+            'total_seconds': sum(ordered),
+            'min_seconds': ordered[0],
+            'mean_seconds': sum(ordered) / len(ordered),
+            'p50_seconds': percentile(0.5),
+            'p95_seconds': percentile(0.95),
+            'max_seconds': ordered[-1],
+            'histogram': histogram
+        }
+    
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'wall_seconds': perf_counter() - self._started,
+                'stages': {stage: self.summarize(timings) for stage, timings in sorted(self.stage_timings.items()) if timings},
+                'fetch_by_expiration': {symbol: dict(timings) for symbol, timings in self.fetch_by_expiration.items()},
+                'bytes_downloaded': self.bytes_downloaded,
+                'candidates': {
+                    'symmetric': self.counters['symmetric_candidates'],
+                    'asymmetric': self.counters['asymmetric_candidates']
+                },
+                'api': {
+                    'calls': self.counters['api_calls'],
+                    'retries': self.counters['retries'],
+                    'connection_errors': self.counters['connection_errors'],
+                    'chain_cache_hits': self.counters['chain_cache_hits'],
+                    'ratelimit_allowed': self.ratelimit_allowed,
+                    'ratelimit_available': self.ratelimit_available
+                },
+                'profile_file': self.profile_file,
+                'profile_top': self.profile_top
+            }
+    
+    def save(self, report_file: str) -> None:
+        with open(report_file, 'w') as report:
+            json.dump(self.to_dict(), report, indent=2)
+
+def report_stage(report: RunReport, stage: str):
+    """
+    report.stage(stage) when there is a report, otherwise a context manager that does nothing.
+    """
+    return report.stage(stage) if report else nullcontext()
+
+
 class Queries(object):
-    def __init__(self, symbol: str, api_key: str):
+    def __init__(
+        self,
+        symbol: str,
+        api_key: str,
+        max_workers: int = 8,
+        pool_size: int = None,
+        timeout: tuple = HTTP_TIMEOUT,
+        max_retries: int = HTTP_MAX_RETRIES,
+        backoff_factor: float = HTTP_BACKOFF_FACTOR,
+        cache: ChainCache = None,
+        api_url: str = TRADIER_API_URL,
+        report: RunReport = None
+    ):
         #to-do: Read the bearer token from a file or something.
         self.headers = {"Accept": "application/json", "Authorization": api_key}
-        self.api = 'https://sandbox.tradier.com{0}'
-        self.ratelimit_available = 120 #I think they say 120 calls/min?
+        self.api = api_url + '{0}'
+        self.rate_limiter = RateLimiter()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.cache = cache
+        self.report = report
         self.symbol = symbol
+        
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        #One keep-alive session for every call, so chain requests skip the TCP+TLS handshake.
+        #Pool defaults to one connection per worker thread.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or max_workers, max_retries=0)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    @property
+    def ratelimit_available(self) -> int:
+        return self.rate_limiter.available
+    
+    def close(self) -> None:
+        self.session.close()
+    
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        """
+        Full jitter exponential backoff, so parallel workers don't retry in lockstep.
+        """
+        delay = uniform(0, min(HTTP_BACKOFF_CAP, self.backoff_factor * (2 ** attempt)))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+    
+    def _get(self, path: str, params: dict) -> 'requests.Response':
+        """
+        GET against the pooled session with the rate limiter, timeouts and bounded retries on 429/5xx
+        and connection errors. Returns the last response, which may still be an error status.
+        """
+        from requests.exceptions import ConnectionError, Timeout
+        url = self.api.format(path)
+        attempt = 0
+        while True:
+            wait_started = perf_counter()
+            self.rate_limiter.acquire()
+            request_started = perf_counter()
+            if self.report:
+                self.report.record('ratelimit_wait', request_started - wait_started)
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (ConnectionError, Timeout):
+                if self.report:
+                    self.report.count('connection_errors')
+                if attempt >= self.max_retries:
+                    raise
+                sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            
+            self.rate_limiter.update(r.headers)
+            if self.report:
+                self.report.record_response(path, perf_counter() - request_started, r, self.rate_limiter.available)
+            if r.status_code in HTTP_RETRY_STATUS_CODES and attempt < self.max_retries:
+                if self.report:
+                    self.report.count('retries')
+                sleep(self._backoff(attempt, r.headers.get('Retry-After')))
+                attempt += 1
+                continue
+            return r
     
     def quotes(self) -> dict:
         """
         Using the inputted quote, grab realtime prices. Used to calculate spreads.
         """
-        url = self.api.format('/v1/markets/quotes')
+        if self.cache:
+            cached = self.cache.get('quote', self.symbol)
+            if cached is not None:
+                return cached
+        
         params = {'symbols': self.symbol}
+        r = None
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            return r.json()['quotes']['quote']
+            r = self._get('/v1/markets/quotes', params)
+            r.raise_for_status()
+            quote = r.json()['quotes']['quote']
         except Exception as e:
-            raise Exception('Problem querying stock quotes. Status code: {0} Error: {1}'.format(r.status_code, e))
+            raise Exception('Problem querying stock quotes. Status code: {0} Error: {1}'.format(getattr(r, 'status_code', None), e))
+        
+        if self.cache:
+            self.cache.put('quote', self.symbol, quote)
+        return quote
+    
+    def batch_quotes(self, symbols: list) -> dict:
+        """
+        Grab quotes for many symbols using as few calls as possible, the quotes endpoint takes a comma separated list.
+        Returns quotes keyed by symbol. Symbols Tradier doesn't recognize are left out.
+        """
+        quotes_by_symbol = {}
+        if self.cache:
+            for symbol in symbols:
+                try:
+                    cached = self.cache.get('quote', symbol)
+                except OfflineCacheMissException:
+                    cached = None
+                if cached is not None:
+                    quotes_by_symbol[symbol] = cached
+            if self.cache.offline:
+                return quotes_by_symbol
+            symbols = [symbol for symbol in symbols if symbol not in quotes_by_symbol]
+        
+        for chunk_start in range(0, len(symbols), QUOTES_PER_REQUEST):
+            params = {'symbols': ','.join(symbols[chunk_start:chunk_start + QUOTES_PER_REQUEST])}
+            r = None
+            try:
+                r = self._get('/v1/markets/quotes', params)
+                r.raise_for_status()
+                quote_data = r.json()['quotes'].get('quote', [])
+            except Exception as e:
+                raise Exception('Problem querying stock quotes. Status code: {0} Error: {1}'.format(getattr(r, 'status_code', None), e))
+            
+            #Tradier returns a bare dict instead of a list when there is only one match.
+            if isinstance(quote_data, dict):
+                quote_data = [quote_data]
+            for quote in quote_data:
+                quotes_by_symbol[quote['symbol']] = quote
+                if self.cache:
+                    self.cache.put('quote', quote['symbol'], quote)
+        return quotes_by_symbol
     
-    def expirations(self) -> list:
+    def expirations(self, symbol: str = None) -> list:
         """
         Need to gather available options expirations before querying the chains.
         """
-        url = self.api.format('/v1/markets/options/expirations')
-        params = {'symbol': self.symbol, 'includeAllRoots': 'true', 'strikes': 'false'}
+        symbol = symbol or self.symbol
+        if self.cache:
+            cached = self.cache.get('expirations', symbol)
+            if cached is not None:
+                return cached
+        
+        params = {'symbol': symbol, 'includeAllRoots': 'true', 'strikes': 'false'}
+        r = None
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            return r.json()['expirations']['date']
+            r = self._get('/v1/markets/options/expirations', params)
+            r.raise_for_status()
+            expirations = r.json()['expirations']['date']
         except Exception as e:
-            raise Exception('Problem querying expirations for {0}. Status code: {1} Error: {2}'.format(self.symbol , r.status_code, e))
+            raise Exception('Problem querying expirations for {0}. Status code: {1} Error: {2}'.format(symbol , getattr(r, 'status_code', None), e))
+        
+        if self.cache:
+            self.cache.put('expirations', symbol, expirations)
+        return expirations
     
-    def options_chain(self, expiration_date: str) -> list:
+    def options_chain(self, expiration_date: str, symbol: str = None) -> list:
         """
         With the option expiration grab the options chain data.
         """
-        url = self.api.format('/v1/markets/options/chains')
-        params = {'symbol': self.symbol, 'expiration': expiration_date, 'greeks': 'true'}
+        symbol = symbol or self.symbol
+        if self.cache:
+            cached = self.cache.get('chain', symbol, expiration_date)
+            if cached is not None:
+                if self.report:
+                    self.report.count('chain_cache_hits')
+                return cached
+        
+        params = {'symbol': symbol, 'expiration': expiration_date, 'greeks': 'true'}
+        r = None
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            return r.json()['options']['option']
+            fetch_started = perf_counter()
+            r = self._get('/v1/markets/options/chains', params)
+            r.raise_for_status()
+            decode_started = perf_counter()
+            options_chain = r.json()['options']['option']
+            if self.report:
+                self.report.record('json_decode', perf_counter() - decode_started)
+                self.report.record_expiration(symbol, expiration_date, perf_counter() - fetch_started)
         except Exception as e:
-            raise Exception('Problem querying options chain for {0}. Status code: {1} Error: {2}'.format(self.symbol , r.status_code, e))
+            raise Exception('Problem querying options chain for {0}. Status code: {1} Error: {2}'.format(symbol , getattr(r, 'status_code', None), e))
+        
+        if self.cache:
+            self.cache.put('chain', symbol, options_chain, expiration_date)
+        return options_chain
     
-    def gather_data(self) -> dict:
+    def gather_data(self, concurrent: bool = True) -> dict:
         """
         Gather and go through the options expirations to collect the chain data.
         Compile it into a dict to be used for calculation.
+        Chains are fetched in parallel by default, throttled by the rate limiter. Pass concurrent=False to
+        fetch them one at a time.
         """
         print('Grabbing current stock price and options expirations.')
-        compiled_data_for_symbol = {}
+        compiled_data_for_symbol = {'as_of': datetime.now().isoformat()}
+        
+        if not concurrent:
+            expirations = self.expirations()
+            compiled_data_for_symbol['stock_quote'] = self.quotes()
+            compiled_data_for_symbol['options_data'] = []
+            
+            for expiration in progress(expirations):
+                options_data = self.options_chain(expiration)
+                compiled_data_for_symbol['options_data'].append({expiration: options_data})
+            
+            return compiled_data_for_symbol
         
-        expirations = self.expirations()
-        compiled_data_for_symbol['stock_quote'] = self.quotes()
-        compiled_data_for_symbol['options_data'] = []
+        compiled_data_for_symbol['stock_quote'], expirations = self.quote_and_expirations()
+        chains_by_expiration = dict(progress(self.iter_chains(expirations), total=len(expirations)))
         
-        for expiration in tqdm.tqdm(expirations):
-            options_data = self.options_chain(expiration)
-            compiled_data_for_symbol['options_data'].append({expiration: options_data})
+        #Keep the same expiration ordering as a serial fetch.
+        compiled_data_for_symbol['options_data'] = [{expiration: chains_by_expiration[expiration]} for expiration in expirations]
         
         return compiled_data_for_symbol
+    
+    def quote_and_expirations(self, symbol: str = None) -> tuple:
+        """
+        The quote doesn't depend on expirations, so both requests go out together.
+        Returns (stock quote, expirations).
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            quote_future = executor.submit(self.quotes)
+            expirations = self.expirations(symbol)
+            return (quote_future.result(), expirations)
+    
+    def iter_chains(self, expirations: list, symbol: str = None):
+        """
+        Fetch the chains for these expirations in parallel and yield (expiration, chain) as each one lands,
+        in whatever order they finish. Nothing is held on to once it's been handed over, so a consumer that
+        works through them as they come only ever keeps one chain around.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            #Submitted nearest expiration first, so those tend to come back first.
+            chain_futures = {executor.submit(self.options_chain, expiration, symbol): expiration for expiration in expirations}
+            for future in as_completed(list(chain_futures)):
+                yield (chain_futures.pop(future), future.result())
+    
+    def gather_batch(self, symbols: list, prepare: bool = False):
+        """
+        Gather data for many symbols under one shared rate limit budget.
+        Quotes come from batched calls, then expirations and chains for every symbol are pipelined through the
+        same thread pool. Yields (symbol, compiled_data_for_symbol) as soon as each symbol's chains are all in,
+        in the same shape gather_data returns. Symbols that fail to fetch are reported and skipped.
+        With prepare=True each chain goes through PreparedChains.prepare_expiration as it lands and the raw chain
+        is dropped, so only the prepared sides and collars are held, and (symbol, PreparedChains) is yielded instead.
+        """
+        print('Grabbing current stock prices for {0} symbols.'.format(len(symbols)))
+        quotes_by_symbol = self.batch_quotes(symbols)
+        pending_symbols = [symbol for symbol in symbols if symbol in quotes_by_symbol]
+        for symbol in symbols:
+            if symbol not in quotes_by_symbol:
+                print('Skipping {0}: no quote returned.'.format(symbol))
+        pending_symbols.reverse()
+        
+        #Chains outstanding and collected per symbol, plus the expirations order to rebuild the list with.
+        remaining_chains = {}
+        chains_by_symbol = defaultdict(dict)
+        expirations_by_symbol = {}
+        failed_symbols = set()
+        #Per symbol PreparedChains the chains get prepared into as they land, with prepare=True.
+        prepared_by_symbol = {}
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = {}
+            
+            def start_next_symbol():
+                symbol = pending_symbols.pop()
+                in_flight[executor.submit(self.expirations, symbol)] = (symbol, None)
+            
+            #Only keep a handful of symbols open at once so finished symbols stream out early
+            #instead of every symbol finishing at the very end.
+            for _ in range(min(self.max_workers, len(pending_symbols))):
+                start_next_symbol()
+            
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    symbol, expiration = in_flight.pop(future)
+                    if symbol in failed_symbols:
+                        continue
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print('Skipping {0}: {1}'.format(symbol, e))
+                        failed_symbols.add(symbol)
+                        for symbol_state in (remaining_chains, chains_by_symbol, expirations_by_symbol, prepared_by_symbol):
+                            symbol_state.pop(symbol, None)
+                        if pending_symbols:
+                            start_next_symbol()
+                        continue
+                    
+                    if expiration is None:
+                        expirations_by_symbol[symbol] = result
+                        remaining_chains[symbol] = len(result)
+                        if prepare:
+                            prepared_by_symbol[symbol] = PreparedChains({'stock_quote': quotes_by_symbol[symbol], 'as_of': datetime.now().isoformat(), 'options_data': []})
+                        for expiration_date in result:
+                            in_flight[executor.submit(self.options_chain, expiration_date, symbol)] = (symbol, expiration_date)
+                    else:
+                        if prepare:
+                            with report_stage(self.report, 'chain_merge'):
+                                result = prepared_by_symbol[symbol].prepare_expiration(expiration, result)
+                        chains_by_symbol[symbol][expiration] = result
+                        remaining_chains[symbol] -= 1
+                    
+                    if remaining_chains[symbol] == 0:
+                        del remaining_chains[symbol]
+                        chains = chains_by_symbol.pop(symbol)
+                        if pending_symbols:
+                            start_next_symbol()
+                        if prepare:
+                            #Same expiration order as a serial fetch.
+                            prepared = prepared_by_symbol.pop(symbol)
+                            prepared.expirations = [chains[expiration_date] for expiration_date in expirations_by_symbol.pop(symbol)]
+                            yield (symbol, prepared)
+                            continue
+                        yield (symbol, {
+                            'as_of': datetime.now().isoformat(),
+                            'stock_quote': quotes_by_symbol[symbol],
+                            'options_data': [{expiration_date: chains[expiration_date]} for expiration_date in expirations_by_symbol.pop(symbol)]
+                        })
 
 
-class Calculations(object):
-    def __init__(self):
-        #Dictionary to store details and data for symmetric collar information.
-        self.overall_data_symmetric = {}
-        
-        #Dictionary to store details and data for asymmetric collar information.
-        self.overall_data_asymmetric = {}
+class TopK(object):
+    """
+    Keeps the best k trades seen so far for one ranking, using a bounded heap.
+    Lowest score wins unless reverse is set. Ties go to the trade seen first, same as a stable sort.
+    k=None keeps everything.
+    """
+    def __init__(self, k: int = TOP_K, reverse: bool = False):
+        self.k = k
+        self.reverse = reverse
+        self._heap = []
+        self._counter = 0
     
-    def calculate_symmetric_collar(self, options_data: dict, util: Decimal, borrow_rate: Decimal) -> tuple:
+    def accepts(self, score) -> bool:
         """
-        Symmetric collar calculations. Assumes you'll be selling an ITM call and buying an OTM put at the same strike.
+        Cheap check before building a record, whether a trade with this score would make the cut.
         """
-        stock_price = Decimal(options_data['stock_quote']['ask']) #Using the stock ask for quick fill assumption.
-        symbol = options_data['stock_quote']['symbol']
+        if self.k is None or len(self._heap) < self.k:
+            return True
+        return (score if self.reverse else -score) > self._heap[0][0]
+    
+    def push(self, score, key: str, record: tuple) -> None:
+        self._counter += 1
+        #Heap root is the worst kept trade. The negative counter makes later trades lose ties.
+        entry = (score if self.reverse else -score, -self._counter, key, score, record)
+        if self.k is None or len(self._heap) < self.k:
+            heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapreplace(self._heap, entry)
+    
+    def ranked(self) -> list:
+        """
+        Kept trades best first, as (key, score, record) tuples.
+        """
+        return [(entry[2], entry[3], entry[4]) for entry in sorted(self._heap, reverse=True)]
+
+
+def format_trade(record: tuple) -> list:
+    """
+    Display strings for a raw trade record, in TRADE_FIELDS order. Only done for rows that get printed.
+    """
+    days_to_profit, annualized_play_performance, breakeven_borrow_rate, call_moneyness, estimated_payout, \
+        cost_of_trade_per_day, expiration_net, strike, expiration_date, profitable = record
+    return [
+        days_to_profit,
+        '{0:.2f}%'.format(annualized_play_performance),
+        '{0:.2f}%'.format(breakeven_borrow_rate),
+        call_moneyness,
+        '${0:.2f}'.format(estimated_payout),
+        '${0:.2f}'.format(cost_of_trade_per_day),
+        '${0:.2f}'.format(expiration_net),
+        #Asymmetric collars carry a (call strike, put strike) pair.
+        '${0}c/{1}p'.format(*map(format_strike, strike)) if isinstance(strike, tuple) else '${0:.2f}'.format(strike),
+        expiration_date,
+        profitable
+    ]
+
+
+def format_strike(strike) -> str:
+    """
+    Strikes read 150 and 152.5, whether they come in as a Decimal or a float from a TradeTable.
+    """
+    return '{0:.0f}'.format(strike) if strike == int(strike) else '{0}'.format(strike)
+
+
+class TradeTable(object):
+    """
+    Compact columnar store of trade records, used for overall_data_symmetric/asymmetric.
+    Each numeric field lives in a typed array, so a row costs tens of bytes instead of a tuple of Decimals.
+    Works like the dictionary of key to TRADE_FIELDS record it replaces. Records come back with floats where the
+    decimal engine had Decimals, since formatting only happens when a row gets printed.
+    """
+    __slots__ = ('collar', 'keys', 'columns', '_rows')
+    
+    def __init__(self, collar: str):
+        self.collar = collar
+        self.keys = []
+        self.columns = {name: array(typecode) for name, typecode in TRADE_COLUMNS}
+        self._rows = {}
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+    
+    def __iter__(self):
+        return iter(self.keys)
+    
+    def __getitem__(self, key: str) -> tuple:
+        return self.record(self._rows[key])
+    
+    def __setitem__(self, key: str, record: tuple) -> None:
+        days_to_profit, annualized_play_performance, breakeven_borrow_rate, call_moneyness, estimated_payout, \
+            cost_of_trade_per_day, expiration_net, strike, expiration_date, profitable = record
+        call_strike, put_strike = strike if isinstance(strike, tuple) else (strike, nan)
+        values = (
+            days_to_profit,
+            float(annualized_play_performance),
+            float(breakeven_borrow_rate),
+            call_moneyness == 'itm',
+            float(estimated_payout),
+            float(cost_of_trade_per_day),
+            float(expiration_net),
+            float(call_strike),
+            float(put_strike),
+            date.fromisoformat(expiration_date).toordinal() - EPOCH_ORDINAL,
+            profitable
+        )
         
-        #Single occurance calculations.
-        daily_fee_payout_amount_per_share_without_utilization = ((( stock_price * ( borrow_rate * IBKR_FEE_SPLIT )) / 365 ) * LOAN_ADJUSTED_RATE )
-        daily_payout_per_options_contract_before_fees = (( daily_fee_payout_amount_per_share_without_utilization * util ) * OPTION_CONTRACT_SIZE )
-        options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
-        buying_power_required = stock_price * OPTION_CONTRACT_SIZE
+        #Streaming re-collects the same trades after every expiration, so existing rows are updated in place.
+        row = self._rows.get(key)
+        if row is None:
+            self._rows[key] = len(self.keys)
+            self.keys.append(key)
+            for column, value in zip(self.columns.values(), values):
+                column.append(value)
+        else:
+            for column, value in zip(self.columns.values(), values):
+                column[row] = value
+    
+    def record(self, row: int) -> tuple:
+        """
+        The TRADE_FIELDS record stored at a row.
+        """
+        columns = self.columns
+        put_strike = columns['put_strike'][row]
+        return (
+            columns['days_to_profit'][row],
+            columns['annualized_play_performance'][row],
+            columns['breakeven_borrow_rate'][row],
+            'itm' if columns['call_itm'][row] else 'otm',
+            columns['estimated_payout'][row],
+            columns['cost_of_trade_per_day'][row],
+            columns['expiration_net'][row],
+            columns['strike'][row] if isnan(put_strike) else (columns['strike'][row], put_strike),
+            date.fromordinal(columns['expiration_date'][row] + EPOCH_ORDINAL).isoformat(),
+            bool(columns['profitable'][row])
+        )
+    
+    def export_rows(self, symbol: str, keys: list = None):
+        """
+        Yield one dictionary of raw values per trade for the CSV and JSON Lines exports, optionally only for keys.
+        """
+        for key in self.keys if keys is None else keys:
+            row = self._rows[key]
+            export_row = {'symbol': symbol, 'collar': self.collar, 'key': key}
+            for name, _ in TRADE_COLUMNS:
+                export_row[name] = self.columns[name][row]
+            export_row['call_itm'] = bool(export_row['call_itm'])
+            export_row['profitable'] = bool(export_row['profitable'])
+            if isnan(export_row['put_strike']):
+                export_row['put_strike'] = None
+            export_row['expiration_date'] = date.fromordinal(export_row['expiration_date'] + EPOCH_ORDINAL).isoformat()
+            yield export_row
+
+
+def to_decimal(value) -> Decimal:
+    """
+    Decimal from a JSON number without dragging in float noise. Whole numbers stay whole so keys read 150c, not 150.0c.
+    """
+    number = Decimal(str(value))
+    return number.quantize(Decimal(1)) if number == number.to_integral_value() else number
+
+def collar_costs(expiration_net, days_remaining: int) -> tuple:
+    """
+    Cost of a collar and that cost spread per day. Only depends on the chain, not the loan fee inputs.
+    """
+    #Convert to positive since it's going to be a fee.
+    if expiration_net > 0:
+        cost_of_trade = 0
+        cost_of_trade_per_day = cost_of_trade
+    else:
+        cost_of_trade = abs(expiration_net - ( OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR ))
+        #Shares get loaned out at the morning auction. If days are zero, this is a losing trade.
+        if days_remaining == 0:
+            cost_of_trade_per_day = cost_of_trade
+        else:
+            cost_of_trade_per_day = cost_of_trade / days_remaining
+    return (cost_of_trade, cost_of_trade_per_day)
+
+
+class StrikeIndex(object):
+    """
+    Compact view of one expiration's chain, parsed in a single pass over the raw option list.
+    Sorted strikes with parallel call bid, put ask and call OCC symbol lists. A side with no quote,
+    or a zero bid/ask, is None since there's no market to put a collar on.
+    """
+    def __init__(self, expiration_date: str, option_chain: list, as_of: datetime):
+        self.expiration_date = expiration_date
+        self.days_remaining = ( datetime.strptime(expiration_date, "%Y-%m-%d") - as_of ).days
         
-        #Dictionary sorted by lowest risk. Uses breakeven days.
-        trades_by_risk = {}
+        #Both puts and calls are needed to calulate profit, but this is listed individually as a list item.
+        #Combine the two as [call bid, put ask, call symbol] per strike.
+        quotes_by_strike = {}
+        for option in option_chain:
+            strike_quotes = quotes_by_strike.setdefault(option['strike'], [None, None, None])
+            if option['option_type'] == 'call':
+                strike_quotes[0] = option['bid']
+                strike_quotes[2] = option['symbol']
+            elif option['option_type'] == 'put':
+                strike_quotes[1] = option['ask']
         
-        #Dictionary sorted by max profit. Uses anualized performance.
-        trades_by_profit = {}
+        self.strikes = []
+        self.call_bids = []
+        self.put_asks = []
+        self.call_symbols = []
+        for strike in sorted(quotes_by_strike):
+            call_bid, put_ask, call_symbol = quotes_by_strike[strike]
+            self.strikes.append(to_decimal(strike))
+            self.call_bids.append(to_decimal(call_bid) if call_bid else None)
+            self.put_asks.append(to_decimal(put_ask) if put_ask else None)
+            self.call_symbols.append(call_symbol)
+
+
+class PreparedChains(object):
+    """
+    Everything about a snapshot that doesn't depend on utilization or borrow rate, worked out once.
+    Holds a StrikeIndex, days remaining and the net and cost of every symmetric collar per expiration,
+    so sweeping many (util, borrow_rate) scenarios only re-applies the fee payout formulas.
+    Asymmetric collars are kept as two sides sorted best first, since a pair's net is just the call side's value
+    plus the put side's value. That lets the calculator walk pairs best first and stop early.
+    Accepts the same options_data that Queries.gather_data returns.
+    """
+    def __init__(self, options_data: dict):
+        self.stock_price = to_decimal(options_data['stock_quote']['ask']) #Using the stock ask for quick fill assumption.
+        self.symbol = options_data['stock_quote']['symbol']
+        #Replayed snapshots count days from when they were taken, not from today.
+        self.as_of = datetime.fromisoformat(options_data['as_of']) if 'as_of' in options_data else datetime.now()
+        self.buying_power_required = self.stock_price * OPTION_CONTRACT_SIZE
+        self.expirations = []
         
         for expiration_list_item in options_data['options_data']:
             for option_chain_for_expiration in expiration_list_item.items():
-                expiration_date = option_chain_for_expiration[0]
-                option_expiration_days_remaining = datetime.strptime(expiration_date, "%Y-%m-%d") - datetime.now()
-                
-                #Both puts and calls are needed to calulate profit, but this is listed individually as a list item.
-                #Do a first pass to combine the two.
-                options_bid_ask_prices = defaultdict(dict)
-                for strike_price_data_first_pass in option_chain_for_expiration[1]:
-                    if strike_price_data_first_pass['option_type'] == 'call':
-                        options_bid_ask_prices[Decimal(strike_price_data_first_pass['strike'])]['call_bid'] = Decimal(strike_price_data_first_pass['bid'])
-                    elif strike_price_data_first_pass['option_type'] == 'put':
-                        options_bid_ask_prices[Decimal(strike_price_data_first_pass['strike'])]['put_ask'] = Decimal(strike_price_data_first_pass['ask'])
-                
-                for strike_price_data_second_pass in option_chain_for_expiration[1]:
-                    #Since a first pass was already done, skip running calculations for puts.
-                    #It's just the same data over again.
-                    if strike_price_data_second_pass['option_type'] == 'put':
-                        continue
-                    else:
-                        total_payout_before_fees = daily_payout_per_options_contract_before_fees * option_expiration_days_remaining.days
-                        option_strike = Decimal(strike_price_data_second_pass['strike'])
-                        occ_options_symbol = strike_price_data_second_pass['symbol']
-                        
-                        #Negative if debit, positive if credit
-                        expiration_net = ((( options_bid_ask_prices[option_strike]['call_bid'] - options_bid_ask_prices[option_strike]['put_ask'] ) - ( stock_price - option_strike )) * OPTION_CONTRACT_SIZE )
-                        
-                        #Convert to positive since it's going to be a fee.
-                        if expiration_net > 0:
-                            cost_of_trade = 0
-                            charge_type = 'credit'
-                            cost_of_trade_per_day = cost_of_trade
-                        else:
-                            cost_of_trade = abs(expiration_net - options_fees_paid)
-                            charge_type = 'debit'
-                            #Shares get loaned out at the morning auction. If days are zero, this is a losing trade.
-                            if option_expiration_days_remaining.days == 0:
-                                cost_of_trade_per_day = cost_of_trade
-                            else:
-                                cost_of_trade_per_day = cost_of_trade / option_expiration_days_remaining.days
-                        
-                        fee_payout_minus_slippage_and_fees = total_payout_before_fees - cost_of_trade
-                        annualized_play_performance = ((( daily_payout_per_options_contract_before_fees - cost_of_trade_per_day ) / buying_power_required ) * 36500 )
-                        breakeven_borrow_rate = (((( cost_of_trade_per_day / buying_power_required) * 36500 ) / IBKR_FEE_SPLIT ) / LOAN_ADJUSTED_RATE )
-                        days_to_profit = ceil(( cost_of_trade / daily_payout_per_options_contract_before_fees ))
-                        
-                        #ToS format. Not really needed at the moment, but kept here in case I want to use it later.
-                        #trade_description = '${0} Collar ${1} for {2} ({3})'.format(symbol, option_strike, expiration_date, option_expiration_days_remaining.days)
-                        
-                        trades_by_risk[occ_options_symbol] = days_to_profit
-                        trades_by_profit[occ_options_symbol] = fee_payout_minus_slippage_and_fees
-                        
-                        self.overall_data_symmetric[occ_options_symbol] = {
-                            'days_to_profit': days_to_profit,
-                            'annualized_play_performance': '{0}%'.format(round(annualized_play_performance, 2)),
-                            'breakeven_borrow_rate': '{0}%'.format(round(breakeven_borrow_rate, 2)),
-                            'call_moneyness': 'itm' if option_strike < stock_price else 'otm',
-                            'estimated_payout': '${0}'.format(round(fee_payout_minus_slippage_and_fees, 2)),
-                            'cost_of_trade_per_day': '${0}'.format(round(cost_of_trade_per_day, 2)),
-                            'expiration_net': '${0}'.format(round(expiration_net, 2)),
-                            'strike': '${0}'.format(round(option_strike, 2)),
-                            'expiration_date': expiration_date,
-                            'profitable': True if days_to_profit < option_expiration_days_remaining.days else False
-                        }
-        
-        return (trades_by_risk, trades_by_profit)
-    
-    def calculate_asymmetric_collar(self, options_data: dict, util: Decimal, borrow_rate: Decimal) -> tuple:
+                self.add_expiration(option_chain_for_expiration[0], option_chain_for_expiration[1])
+    
+    def __getstate__(self) -> dict:
+        #Sent to process pool workers. The strike indexes are only needed while preparing and the numpy sides
+        #get rebuilt on first use, so they're left behind to keep the pickle small.
+        state = self.__dict__.copy()
+        state['expirations'] = [dict(expiration, strike_index=None, numpy_sides=None) for expiration in self.expirations]
+        return state
+    
+    def breakeven_borrow_rate(self, cost_of_trade_per_day):
+        return (((( cost_of_trade_per_day / self.buying_power_required) * 36500 ) / IBKR_FEE_SPLIT ) / LOAN_ADJUSTED_RATE )
+    
+    def add_expiration(self, expiration_date: str, option_chain: list) -> None:
+        self.expirations.append(self.prepare_expiration(expiration_date, option_chain))
+    
+    def prepare_expiration(self, expiration_date: str, option_chain: list) -> dict:
+        """
+        Index one expiration's chain and work out its symmetric collars and asymmetric sides.
+        """
+        stock_price = self.stock_price
+        strike_index = StrikeIndex(expiration_date, option_chain, self.as_of)
+        days_remaining = strike_index.days_remaining
+        
+        #Symmetric collars as (occ symbol, strike, expiration net, cost of trade, cost per day, breakeven borrow rate).
+        symmetric_collars = []
+        #Asymmetric sides as (value, strike). OTM calls are worth their bid, OTM puts cost their ask less the
+        #distance from the stock price down to the strike.
+        call_side = []
+        put_side = []
+        for option_strike, call_bid, put_ask, call_symbol in zip(strike_index.strikes, strike_index.call_bids, strike_index.put_asks, strike_index.call_symbols):
+            if call_bid is not None and put_ask is not None:
+                #Negative if debit, positive if credit
+                expiration_net = ((( call_bid - put_ask ) - ( stock_price - option_strike )) * OPTION_CONTRACT_SIZE )
+                cost_of_trade, cost_of_trade_per_day = collar_costs(expiration_net, days_remaining)
+                symmetric_collars.append((
+                    call_symbol,
+                    option_strike,
+                    expiration_net,
+                    cost_of_trade,
+                    cost_of_trade_per_day,
+                    self.breakeven_borrow_rate(cost_of_trade_per_day)
+                ))
+            
+            #ITM calls are covered by symmetric collars.
+            if call_bid is not None and not option_strike < stock_price:
+                call_side.append((call_bid * OPTION_CONTRACT_SIZE, option_strike))
+            if put_ask is not None and not option_strike > stock_price:
+                put_side.append((( option_strike - put_ask - stock_price ) * OPTION_CONTRACT_SIZE, option_strike))
+        
+        #Stable sorts, so equal values keep strike order.
+        call_side.sort(key=lambda side: side[0], reverse=True)
+        put_side.sort(key=lambda side: side[0], reverse=True)
+        
+        return {
+            'expiration_date': expiration_date,
+            'days_remaining': days_remaining,
+            'strike_index': strike_index,
+            'symmetric_collars': symmetric_collars,
+            'call_side': call_side,
+            'put_side': put_side,
+            'numpy_sides': None
+        }
+    
+    def numpy_sides(self, expiration: dict) -> tuple:
+        """
+        Asymmetric sides as float64 arrays for the numpy engine, built on first use.
+        Returns (call strikes, call values, put strikes, put values), still best first.
+        """
+        if expiration['numpy_sides'] is None:
+            numpy = import_numpy()
+            expiration['numpy_sides'] = (
+                [side[1] for side in expiration['call_side']],
+                numpy.array([float(side[0]) for side in expiration['call_side']], dtype=numpy.float64),
+                [side[1] for side in expiration['put_side']],
+                numpy.array([float(side[0]) for side in expiration['put_side']], dtype=numpy.float64)
+            )
+        return expiration['numpy_sides']
+
+
+def asymmetric_pairs_best_first(call_side: list, put_side: list):
+    """
+    Walk every (call, put) pair in order of highest expiration net first, without building the grid.
+    Both sides are sorted best first, so from pair (i, j) the next candidates are only (i, j+1) and (i+1, 0).
+    Yields ((call strike, put strike), expiration net).
+    """
+    if not call_side or not put_side:
+        return
+    frontier = [(-( call_side[0][0] + put_side[0][0] ), 0, 0)]
+    while frontier:
+        negative_net, call_position, put_position = heappop(frontier)
+        yield ((call_side[call_position][1], put_side[put_position][1]), -negative_net)
+        if put_position + 1 < len(put_side):
+            heappush(frontier, (-( call_side[call_position][0] + put_side[put_position + 1][0] ), call_position, put_position + 1))
+        if put_position == 0 and call_position + 1 < len(call_side):
+            heappush(frontier, (-( call_side[call_position + 1][0] + put_side[0][0] ), call_position + 1, 0))
+
+
+class Calculations(object):
+    def __init__(self, top_k: int = TOP_K, rankings: tuple = RANKINGS, report: RunReport = None):
+        #Raw trade records in TRADE_FIELDS order for symmetric collars that made any ranking.
+        self.overall_data_symmetric = TradeTable('symmetric')
+        
+        #Raw trade records in TRADE_FIELDS order for asymmetric collars that made any ranking.
+        self.overall_data_asymmetric = TradeTable('asymmetric')
+        
+        #How many trades to keep per ranking, and the (field, highest is best) pairs to rank by.
+        self.top_k = top_k
+        self.rankings = rankings
+        
+        #Optional RunReport for stage timings and candidate counts.
+        self.report = report
+    
+    def _prepare(self, options_data) -> PreparedChains:
+        if isinstance(options_data, PreparedChains):
+            return options_data
+        with report_stage(self.report, 'chain_merge'):
+            return PreparedChains(options_data)
+    
+    def _new_rankings(self) -> list:
+        return [(TopK(self.top_k, reverse), TRADE_FIELDS.index(field)) for field, reverse in self.rankings]
+    
+    def _can_prune(self) -> bool:
+        """
+        Whether the asymmetric search can stop early, see NET_MONOTONE_RANKINGS.
+        """
+        return self.top_k is not None and all(ranking in NET_MONOTONE_RANKINGS for ranking in self.rankings)
+    
+    def _collect_rankings(self, rankings: list, overall_data: TradeTable) -> tuple:
+        """
+        Turn the ranking heaps into one best first dictionary of key to score per ranking,
+        and store the records of every kept trade.
+        """
+        ranked_trades = []
+        for top_k, _ in rankings:
+            trades = {}
+            for key, score, record in top_k.ranked():
+                trades[key] = score
+                overall_data[key] = record
+            ranked_trades.append(trades)
+        return tuple(ranked_trades)
+    
+    def _merge_rankings(self, rankings: list, partial_rankings: list) -> None:
+        """
+        Offer the (key, score, record) tuples of partial rankings, e.g. from one chunk of expirations, to each ranking.
+        """
+        for (top_k, _), partial_ranking in zip(rankings, partial_rankings):
+            for key, score, record in partial_ranking:
+                if top_k.accepts(score):
+                    top_k.push(score, key, record)
+    
+    def daily_payout(self, prepared: PreparedChains, util: Decimal, borrow_rate: Decimal) -> Decimal:
+        """
+        Loan fee paid per options contract worth of shares per day, before fees. The only part that depends on the inputs.
+        """
+        daily_fee_payout_amount_per_share_without_utilization = ((( prepared.stock_price * ( borrow_rate * IBKR_FEE_SPLIT )) / 365 ) * LOAN_ADJUSTED_RATE )
+        return (( daily_fee_payout_amount_per_share_without_utilization * util ) * OPTION_CONTRACT_SIZE )
+    
+    def _resolve_engine(self, engine: str) -> str:
+        #Pruned searches only score a K x K corner per expiration, where numpy's import and float drift cost more
+        #than they save. numpy is opt-in for unpruned searches, which it does speed up a lot.
+        if engine is None:
+            engine = 'decimal'
+        if engine == 'numpy' and import_numpy() is None:
+            raise Exception('The numpy engine needs numpy installed. pip install numpy')
+        return engine
+    
+    def _rank_symmetric_expiration(self, prepared: PreparedChains, expiration: dict, daily_payout_per_options_contract_before_fees: Decimal, rankings: list) -> int:
+        """
+        Apply the loan fee payout to one expiration's symmetric collars and offer them to each ranking.
+        Returns how many collars were evaluated.
+        """
+        stock_price = prepared.stock_price
+        buying_power_required = prepared.buying_power_required
+        expiration_date = expiration['expiration_date']
+        days_remaining = expiration['days_remaining']
+        total_payout_before_fees = daily_payout_per_options_contract_before_fees * days_remaining
+        
+        for occ_options_symbol, option_strike, expiration_net, cost_of_trade, cost_of_trade_per_day, breakeven_borrow_rate in expiration['symmetric_collars']:
+            fee_payout_minus_slippage_and_fees = total_payout_before_fees - cost_of_trade
+            annualized_play_performance = ((( daily_payout_per_options_contract_before_fees - cost_of_trade_per_day ) / buying_power_required ) * 36500 )
+            days_to_profit = ceil(( cost_of_trade / daily_payout_per_options_contract_before_fees ))
+            
+            #ToS format. Not really needed at the moment, but kept here in case I want to use it later.
+            #trade_description = '${0} Collar ${1} for {2} ({3})'.format(symbol, option_strike, expiration_date, days_remaining)
+            
+            record = (
+                days_to_profit,
+                annualized_play_performance,
+                breakeven_borrow_rate,
+                'itm' if option_strike < stock_price else 'otm',
+                fee_payout_minus_slippage_and_fees,
+                cost_of_trade_per_day,
+                expiration_net,
+                option_strike,
+                expiration_date,
+                True if days_to_profit < days_remaining else False
+            )
+            for top_k, field_index in rankings:
+                if top_k.accepts(record[field_index]):
+                    top_k.push(record[field_index], occ_options_symbol, record)
+        return len(expiration['symmetric_collars'])
+    
+    def _rank_asymmetric_expiration(
+        self,
+        prepared: PreparedChains,
+        expiration: dict,
+        daily_payout_per_options_contract_before_fees: Decimal,
+        rankings: list,
+        engine: str,
+        can_prune: bool
+    ) -> int:
+        """
+        Apply the loan fee payout to one expiration's asymmetric collars and offer them to each ranking.
+        Returns how many strike pairs were evaluated.
+        """
+        if engine == 'numpy':
+            return self._rank_asymmetric_grid(prepared, expiration, float(daily_payout_per_options_contract_before_fees), rankings, can_prune)
+        
+        pairs_evaluated = 0
+        buying_power_required = prepared.buying_power_required
+        expiration_date = expiration['expiration_date']
+        days_remaining = expiration['days_remaining']
+        total_payout_before_fees = daily_payout_per_options_contract_before_fees * days_remaining
+        
+        #Since this is asymmetric, go through the otm combinations, best expiration net first.
+        for strikes, expiration_net in asymmetric_pairs_best_first(expiration['call_side'], expiration['put_side']):
+            pairs_evaluated += 1
+            cost_of_trade, cost_of_trade_per_day = collar_costs(expiration_net, days_remaining)
+            breakeven_borrow_rate = prepared.breakeven_borrow_rate(cost_of_trade_per_day)
+            fee_payout_minus_slippage_and_fees = total_payout_before_fees - cost_of_trade
+            annualized_play_performance = ((( daily_payout_per_options_contract_before_fees - cost_of_trade_per_day ) / buying_power_required ) * 36500 )
+            days_to_profit = ceil(( cost_of_trade / daily_payout_per_options_contract_before_fees ))
+            
+            record = (
+                days_to_profit,
+                annualized_play_performance,
+                breakeven_borrow_rate,
+                'otm',
+                fee_payout_minus_slippage_and_fees,
+                cost_of_trade_per_day,
+                expiration_net,
+                strikes,
+                expiration_date,
+                True if days_to_profit < days_remaining else False
+            )
+            accepted = False
+            for top_k, field_index in rankings:
+                if top_k.accepts(record[field_index]):
+                    #Strike pairs repeat across expirations, so the expiration is part of the key.
+                    top_k.push(record[field_index], '{0} {1}c/{2}p'.format(expiration_date, *strikes), record)
+                    accepted = True
+            #Every pair after this one has a lower net, so none of them can make a ranking either.
+            if can_prune and not accepted:
+                break
+        return pairs_evaluated
+    
+    def calculate_symmetric_collar(self, options_data, util: Decimal, borrow_rate: Decimal) -> tuple:
+        """
+        Symmetric collar calculations. Assumes you'll be selling an ITM call and buying an OTM put at the same strike.
+        options_data is either gathered data or a PreparedChains to reuse across scenarios.
+        Returns one dictionary per ranking, best first. With the default rankings that's (trades_by_risk, trades_by_profit).
+        """
+        prepared = self._prepare(options_data)
+        
+        with report_stage(self.report, 'symmetric'):
+            #Single occurance calculations.
+            daily_payout_per_options_contract_before_fees = self.daily_payout(prepared, util, borrow_rate)
+            
+            #Default rankings are lowest risk by breakeven days, and max profit by estimated payout.
+            rankings = self._new_rankings()
+            
+            candidates = 0
+            for expiration in prepared.expirations:
+                candidates += self._rank_symmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, rankings)
+            
+            ranked_trades = self._collect_rankings(rankings, self.overall_data_symmetric)
+        if self.report:
+            self.report.count('symmetric_candidates', candidates)
+        return ranked_trades
+    
+    def calculate_asymmetric_collar(
+        self,
+        options_data,
+        util: Decimal,
+        borrow_rate: Decimal,
+        engine: str = None,
+        validate: bool = False,
+        processes: int = None
+    ) -> tuple:
         """
         Asymmetric collar calculations. Assumes you'll be selling an OTM call and buying an OTM put at different strikes.
+        options_data is either gathered data or a PreparedChains to reuse across scenarios.
+        Returns one dictionary per ranking, best first. With the default rankings that's (trades_by_risk, trades_by_profit).
+        engine is 'decimal' for the original per pair math, the default, or 'numpy' for the vectorized grid, worth it
+        for unpruned searches. validate=True also runs the decimal path and raises if the two disagree.
+        processes > 1 spreads the expirations over a process pool for unpruned searches. Pruned ones only score
+        about K pairs per expiration, far less than the pool costs to start and feed, so they stay serial.
+        """
+        engine = self._resolve_engine(engine)
+        prepared = self._prepare(options_data)
+        
+        with report_stage(self.report, 'asymmetric'):
+            #Single occurance calculations.
+            daily_payout_per_options_contract_before_fees = self.daily_payout(prepared, util, borrow_rate)
+            
+            #Default rankings are lowest risk by breakeven days, and max profit by estimated payout.
+            rankings = self._new_rankings()
+            can_prune = self._can_prune()
+            
+            if processes and processes > 1 and not can_prune and len(prepared.expirations) > 1:
+                candidates = self._rank_asymmetric_parallel(prepared, daily_payout_per_options_contract_before_fees, rankings, engine, can_prune, processes)
+            else:
+                candidates = 0
+                for expiration in prepared.expirations:
+                    candidates += self._rank_asymmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, rankings, engine, can_prune)
+            
+            ranked_trades = self._collect_rankings(rankings, self.overall_data_asymmetric)
+        if self.report:
+            self.report.count('asymmetric_candidates', candidates)
+        if validate and engine != 'decimal':
+            self._validate_asymmetric_engine(prepared, util, borrow_rate, ranked_trades)
+        
+        return ranked_trades
+    
+    def _rank_asymmetric_parallel(
+        self,
+        prepared: PreparedChains,
+        daily_payout_per_options_contract_before_fees: Decimal,
+        rankings: list,
+        engine: str,
+        can_prune: bool,
+        processes: int
+    ) -> int:
+        """
+        Fan the expirations out over a process pool, one chunk per process, and merge each worker's partial
+        rankings back into these ones. Workers only get the asymmetric sides of their expirations and only send
+        back their top K per ranking, so pickling stays small. Returns how many strike pairs were evaluated.
         """
-        stock_price = Decimal(options_data['stock_quote']['ask']) #Using the stock ask for quick fill assumption.
-        symbol = options_data['stock_quote']['symbol']
+        stock_quote = {'symbol': prepared.symbol, 'ask': prepared.stock_price}
+        chunk_size = ceil(len(prepared.expirations) / processes)
+        tasks = []
+        #Consecutive chunks merged back in order keep ties ranked the same as the serial path.
+        for chunk_start in range(0, len(prepared.expirations), chunk_size):
+            expirations = [
+                (expiration['expiration_date'], expiration['days_remaining'], expiration['call_side'], expiration['put_side'])
+                for expiration in prepared.expirations[chunk_start:chunk_start + chunk_size]
+            ]
+            tasks.append((stock_quote, prepared.as_of.isoformat(), daily_payout_per_options_contract_before_fees, self.top_k, self.rankings, engine, can_prune, expirations))
         
-        #Single occurance calculations.
-        daily_fee_payout_amount_per_share_without_utilization = ((( stock_price * ( borrow_rate * IBKR_FEE_SPLIT )) / 365 ) * LOAN_ADJUSTED_RATE )
-        daily_payout_per_options_contract_before_fees = (( daily_fee_payout_amount_per_share_without_utilization * util ) * OPTION_CONTRACT_SIZE )
+        candidates = 0
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            for partial_rankings, chunk_candidates in executor.map(rank_asymmetric_chunk, tasks):
+                candidates += chunk_candidates
+                self._merge_rankings(rankings, partial_rankings)
+        return candidates
+    
+    def stream_collars(
+        self,
+        stock_quote: dict,
+        chains,
+        util: Decimal,
+        borrow_rate: Decimal,
+        as_of: str = None,
+        engine: str = None,
+        expirations: list = None
+    ):
+        """
+        Run both collar calculations as chains arrive, e.g. from Queries.iter_chains.
+        chains is any iterable of (expiration date, option chain). Each chain is indexed, ranked and dropped,
+        so only one expiration's chain is held at a time.
+        Chains can land in any order, so each one is ranked on its own and merged in expirations order, keeping
+        ties ranked the same as a serial run whichever download finished first. Without expirations they merge
+        in the order they arrive.
+        Yields (expiration date, symmetric rankings, asymmetric rankings) after every expiration, so the last
+        item holds the final rankings. Records for the kept trades are in overall_data_symmetric/asymmetric.
+        """
+        engine = self._resolve_engine(engine)
+        prepared = PreparedChains({'stock_quote': stock_quote, 'as_of': as_of or datetime.now().isoformat(), 'options_data': []})
+        daily_payout_per_options_contract_before_fees = self.daily_payout(prepared, util, borrow_rate)
+        symmetric_rankings = self._new_rankings()
+        asymmetric_rankings = self._new_rankings()
+        can_prune = self._can_prune()
+        
+        #Partial rankings waiting on an earlier expiration, by position in expirations.
+        positions = {expiration_date: position for position, expiration_date in enumerate(expirations or [])}
+        pending = {}
+        next_position = 0
+        
+        def merge_pending(position: int, through_position: int = 0) -> int:
+            """Merge the pending partial rankings in order from position, past gaps only up to through_position."""
+            while position in pending or position < through_position:
+                if position in pending:
+                    symmetric_partial, asymmetric_partial = pending.pop(position)
+                    self._merge_rankings(symmetric_rankings, symmetric_partial)
+                    self._merge_rankings(asymmetric_rankings, asymmetric_partial)
+                position += 1
+            return position
+        
+        expiration_date = None
+        for expiration_date, option_chain in chains:
+            with report_stage(self.report, 'chain_merge'):
+                expiration = prepared.prepare_expiration(expiration_date, option_chain)
+            symmetric_partial = self._new_rankings()
+            asymmetric_partial = self._new_rankings()
+            with report_stage(self.report, 'symmetric'):
+                symmetric_candidates = self._rank_symmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, symmetric_partial)
+            with report_stage(self.report, 'asymmetric'):
+                asymmetric_candidates = self._rank_asymmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, asymmetric_partial, engine, can_prune)
+            pending[positions.setdefault(expiration_date, len(positions))] = (
+                [top_k.ranked() for top_k, _ in symmetric_partial],
+                [top_k.ranked() for top_k, _ in asymmetric_partial]
+            )
+            next_position = merge_pending(next_position)
+            with report_stage(self.report, 'symmetric'):
+                symmetric_output = self._collect_rankings(symmetric_rankings, self.overall_data_symmetric)
+            with report_stage(self.report, 'asymmetric'):
+                asymmetric_output = self._collect_rankings(asymmetric_rankings, self.overall_data_asymmetric)
+            if self.report:
+                self.report.count('symmetric_candidates', symmetric_candidates)
+                self.report.count('asymmetric_candidates', asymmetric_candidates)
+            yield (expiration_date, symmetric_output, asymmetric_output)
+        
+        #Expirations that never came in leave gaps, merge whatever is still waiting behind them.
+        if pending:
+            merge_pending(next_position, max(pending) + 1)
+            yield (
+                expiration_date,
+                self._collect_rankings(symmetric_rankings, self.overall_data_symmetric),
+                self._collect_rankings(asymmetric_rankings, self.overall_data_asymmetric)
+            )
+    
+    def _rank_asymmetric_grid(self, prepared: PreparedChains, expiration: dict, daily_payout: float, rankings: list, can_prune: bool) -> int:
+        """
+        Build one expiration's call x put grid as float64 broadcasts and offer the best pairs to each ranking.
+        Calls are the rows and puts the columns. When pruning, the top K pairs by net can only use the top K
+        calls and top K puts, so the grid is cut down to that corner first.
+        Only the best few pairs per ranking can make the cut, so they're picked out with a stable argsort
+        and records are built for those alone. Returns the size of the grid.
+        """
+        numpy = import_numpy()
+        call_strikes, call_values, put_strikes, put_values = prepared.numpy_sides(expiration)
+        if can_prune:
+            call_strikes, call_values = call_strikes[:self.top_k], call_values[:self.top_k]
+            put_strikes, put_values = put_strikes[:self.top_k], put_values[:self.top_k]
+        put_count = len(put_strikes)
+        if not put_count or not call_strikes:
+            return 0
+        
+        days_remaining = expiration['days_remaining']
+        buying_power = float(prepared.buying_power_required)
         options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
-        buying_power_required = stock_price * OPTION_CONTRACT_SIZE
         
-        #Dictionary sorted by lowest risk. Uses breakeven days.
-        trades_by_risk = {}
+        #Negative if debit, positive if credit
+        expiration_net = call_values[:, None] + put_values[None, :]
+        cost_of_trade = numpy.where(expiration_net > 0, 0.0, numpy.abs(expiration_net - options_fees_paid))
+        #Shares get loaned out at the morning auction. If days are zero, this is a losing trade.
+        cost_of_trade_per_day = cost_of_trade if days_remaining == 0 else cost_of_trade / days_remaining
+        days_to_profit = numpy.ceil( cost_of_trade / daily_payout ).astype(numpy.int64)
+        columns = {
+            'days_to_profit': days_to_profit,
+            'annualized_play_performance': (( daily_payout - cost_of_trade_per_day ) / buying_power ) * 36500,
+            'breakeven_borrow_rate': ((( cost_of_trade_per_day / buying_power ) * 36500 ) / float(IBKR_FEE_SPLIT) ) / float(LOAN_ADJUSTED_RATE),
+            'estimated_payout': ( daily_payout * days_remaining ) - cost_of_trade,
+            'cost_of_trade_per_day': cost_of_trade_per_day,
+            'expiration_net': expiration_net,
+            'profitable': days_to_profit < days_remaining
+        }
         
-        #Dictionary sorted by max profit. Uses anualized performance.
-        trades_by_profit = {}
+        for top_k, field_index in rankings:
+            field = TRADE_FIELDS[field_index]
+            if field not in columns:
+                raise Exception('Can not rank asymmetric collars by {0}.'.format(field))
+            scores = columns[field].ravel()
+            order = numpy.argsort(-scores if top_k.reverse else scores, kind='stable')
+            if top_k.k is not None:
+                order = order[:top_k.k]
+            for flat_index in order.tolist():
+                score = scores[flat_index].item()
+                if not top_k.accepts(score):
+                    break
+                call_strike = call_strikes[flat_index // put_count]
+                put_strike = put_strikes[flat_index % put_count]
+                record = (
+                    columns['days_to_profit'].item(flat_index),
+                    columns['annualized_play_performance'].item(flat_index),
+                    columns['breakeven_borrow_rate'].item(flat_index),
+                    'otm',
+                    columns['estimated_payout'].item(flat_index),
+                    columns['cost_of_trade_per_day'].item(flat_index),
+                    columns['expiration_net'].item(flat_index),
+                    (call_strike, put_strike),
+                    expiration['expiration_date'],
+                    columns['profitable'].item(flat_index)
+                )
+                top_k.push(score, '{0} {1}c/{2}p'.format(expiration['expiration_date'], call_strike, put_strike), record)
+        return len(call_strikes) * put_count
+    
+    def _validate_asymmetric_engine(self, prepared: PreparedChains, util: Decimal, borrow_rate: Decimal, engine_output: tuple) -> None:
+        """
+        Cross check a vectorized run against the decimal path, ranking by ranking. Scores are compared in rank order
+        since ties can be broken differently. Floats are allowed to drift by a fraction of a cent, and ceil() can land
+        either side of a whole number of days when the ratio is right on it.
+        """
+        reference_output = Calculations(self.top_k, self.rankings).calculate_asymmetric_collar(prepared, util, borrow_rate, engine='decimal')
         
-        for expiration_list_item in options_data['options_data']:
-            for option_chain_for_expiration in expiration_list_item.items():
-                expiration_date = option_chain_for_expiration[0]
-                option_expiration_days_remaining = datetime.strptime(expiration_date, "%Y-%m-%d") - datetime.now()
-                
-                total_payout_before_fees = daily_payout_per_options_contract_before_fees * option_expiration_days_remaining.days
-                
-                #Both puts and calls are needed to calulate profit, but this is listed individually as a list item.
-                #Do a first pass to combine the two.
-                options_bid_ask_prices = defaultdict(dict)
-                for strike_price_data_first_pass in option_chain_for_expiration[1]:
-                    if strike_price_data_first_pass['option_type'] == 'call':
-                        options_bid_ask_prices[Decimal(strike_price_data_first_pass['strike'])]['call_bid'] = Decimal(strike_price_data_first_pass['bid'])
-                    elif strike_price_data_first_pass['option_type'] == 'put':
-                        options_bid_ask_prices[Decimal(strike_price_data_first_pass['strike'])]['put_ask'] = Decimal(strike_price_data_first_pass['ask'])
-                
-                #Since this is asymmetric, calculate all possible otm calculations.
-                #Done as a second pass and creates data to be iterrated on for the third pass doing the final calculations.
-                #Stored as a dictionary with combination strikes as the key and the expiration net calculation as the value.
-                otm_options_collar_combinations = defaultdict(dict)
-                available_strikes = options_bid_ask_prices.keys()
-                for call_strike in available_strikes:
-                    #ITM calls are covered by symmetric collars.
-                    if call_strike < stock_price:
-                        continue
-                    else:
-                        for put_strike in available_strikes:
-                            if put_strike > stock_price:
-                                continue
-                            else:
-                                combination_strike = '{0}c/{1}p'.format(call_strike, put_strike)
-                                #Negative if debit, positive if credit
-                                expiration_net = ((( options_bid_ask_prices[call_strike]['call_bid'] - options_bid_ask_prices[put_strike]['put_ask'] ) - ( stock_price - put_strike )) * OPTION_CONTRACT_SIZE )
-                            
-                                otm_options_collar_combinations[combination_strike] = expiration_net
-                
-                #Third pass, run the remaining calculations based off of predetermined combinations.
-                for collar_combination in otm_options_collar_combinations.items():
-                    if collar_combination[1] > 0:
-                        cost_of_trade = 0
-                        charge_type = 'credit'
-                        cost_of_trade_per_day = cost_of_trade
-                    else:
-                        cost_of_trade = abs(collar_combination[1] - options_fees_paid)
-                        charge_type = 'debit'
-                        #Shares get loaned out at the morning auction. If days are zero, this is a losing trade.
-                        if option_expiration_days_remaining.days == 0:
-                            cost_of_trade_per_day = cost_of_trade
-                        else:
-                            cost_of_trade_per_day = cost_of_trade / option_expiration_days_remaining.days
-                    
-                    fee_payout_minus_slippage_and_fees = total_payout_before_fees - cost_of_trade
-                    annualized_play_performance = ((( daily_payout_per_options_contract_before_fees - cost_of_trade_per_day ) / buying_power_required ) * 36500 )
-                    breakeven_borrow_rate = (((( cost_of_trade_per_day / buying_power_required) * 36500 ) / IBKR_FEE_SPLIT ) / LOAN_ADJUSTED_RATE )
-                    days_to_profit = ceil(( cost_of_trade / daily_payout_per_options_contract_before_fees ))
-                    
-                    trades_by_risk[collar_combination[0]] = days_to_profit
-                    trades_by_profit[collar_combination[0]] = fee_payout_minus_slippage_and_fees
-                    
-                    self.overall_data_asymmetric[collar_combination[0]] = {
-                        'days_to_profit': days_to_profit,
-                        'annualized_play_performance': '{0}%'.format(round(annualized_play_performance, 2)),
-                        'breakeven_borrow_rate': '{0}%'.format(round(breakeven_borrow_rate, 2)),
-                        'call_moneyness': 'otm',
-                        'estimated_payout': '${0}'.format(round(fee_payout_minus_slippage_and_fees, 2)),
-                        'cost_of_trade_per_day': '${0}'.format(round(cost_of_trade_per_day, 2)),
-                        'expiration_net': '${0}'.format(round(collar_combination[1], 2)),
-                        'strike': '${0}'.format(collar_combination[0]),
-                        'expiration_date': expiration_date,
-                        'profitable': True if days_to_profit < option_expiration_days_remaining.days else False
-                    }
-        
-        return (trades_by_risk, trades_by_profit)
+        for (field, _), reference_trades, engine_trades in zip(self.rankings, reference_output, engine_output):
+            if len(reference_trades) != len(engine_trades):
+                raise EngineValidationException('Asymmetric engines kept a different number of trades ranked by {0}.'.format(field))
+            tolerance = 1 if field == 'days_to_profit' else 0.005
+            for rank, (reference_score, engine_score) in enumerate(zip(reference_trades.values(), engine_trades.values())):
+                if abs(engine_score - float(reference_score)) > tolerance:
+                    raise EngineValidationException('Mismatch ranked by {0} at rank {1}: {2} vs {3}.'.format(field, rank + 1, engine_score, reference_score))
+    
+    def sensitivity_table(self, options_data, utils: list, borrow_rates: list, engine: str = None) -> list:
+        """
+        Best trades for every (util, borrow_rate) scenario. The chain work is done once up front and
+        each scenario only re-applies the loan fee payout.
+        Returns one dict per scenario with the util, borrow_rate, and the best record per ranking for
+        symmetric and asymmetric collars (None when there are no collars).
+        """
+        prepared = self._prepare(options_data)
+        scenarios = []
+        for util in utils:
+            for borrow_rate in borrow_rates:
+                #Fresh object per scenario, records for the same collar differ between scenarios.
+                scenario_calc = Calculations(1, self.rankings, self.report)
+                symmetric_output = scenario_calc.calculate_symmetric_collar(prepared, util, borrow_rate)
+                asymmetric_output = scenario_calc.calculate_asymmetric_collar(prepared, util, borrow_rate, engine=engine)
+                scenarios.append({
+                    'util': util,
+                    'borrow_rate': borrow_rate,
+                    'symmetric': [scenario_calc.overall_data_symmetric[next(iter(trades))] if trades else None for trades in symmetric_output],
+                    'asymmetric': [scenario_calc.overall_data_asymmetric[next(iter(trades))] if trades else None for trades in asymmetric_output]
+                })
+        return scenarios
 
 
-if __name__ == '__main__':
-    tradier_sandbox_api_key = tradier_key()
-    input = input_section()
+def rank_asymmetric_chunk(task: tuple) -> tuple:
+    """
+    Process pool worker for Calculations._rank_asymmetric_parallel. Ranks the asymmetric collars of a chunk of
+    expirations and returns (the kept (key, score, record) tuples per ranking, strike pairs evaluated).
+    Lives at module level so it can be pickled.
+    """
+    stock_quote, as_of, daily_payout_per_options_contract_before_fees, top_k, rankings, engine, can_prune, expirations = task
+    prepared = PreparedChains({'stock_quote': stock_quote, 'as_of': as_of, 'options_data': []})
+    calc_obj = Calculations(top_k, rankings)
+    chunk_rankings = calc_obj._new_rankings()
+    candidates = 0
+    for expiration_date, days_remaining, call_side, put_side in expirations:
+        expiration = {
+            'expiration_date': expiration_date,
+            'days_remaining': days_remaining,
+            'call_side': call_side,
+            'put_side': put_side,
+            'numpy_sides': None
+        }
+        candidates += calc_obj._rank_asymmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, chunk_rankings, engine, can_prune)
+    return ([top_k.ranked() for top_k, _ in chunk_rankings], candidates)
+
+def calculate_symbol(
+    options_data: dict,
+    util: Decimal,
+    borrow_rate: Decimal,
+    instrument: bool = False,
+    top_k: int = TOP_K,
+    processes: int = None
+) -> tuple:
+    """
+    Both collar calculations for one symbol. Process pool worker for batch runs, lives at module level so it
+    can be pickled. Returns (calc_obj, symbol, symmetric rankings, asymmetric rankings).
+    With instrument=True, calc_obj.report holds this worker's timings to merge into the run report.
+    """
+    calc_obj = Calculations(top_k, report=RunReport() if instrument else None)
+    prepared = calc_obj._prepare(options_data)
+    return (
+        calc_obj,
+        prepared.symbol,
+        calc_obj.calculate_symmetric_collar(prepared, util, borrow_rate),
+        calc_obj.calculate_asymmetric_collar(prepared, util, borrow_rate, processes=processes)
+    )
+
+
+class CollarWatch(object):
+    """
+    Resident state for one symbol in watch mode. Keeps the raw chain, a fingerprint of its quotes and the ranked
+    trades per expiration, so each refresh only re-fetches the chains that are due and only recomputes the
+    expirations whose chain changed. A stock move past reprice_threshold or a new day recomputes everything from
+    the chains held.
+    """
+    def __init__(
+        self,
+        symbol: str,
+        util: Decimal,
+        borrow_rate: Decimal,
+        top_k: int = TOP_K,
+        engine: str = None,
+        reprice_threshold: Decimal = WATCH_REPRICE_THRESHOLD
+    ):
+        self.symbol = symbol
+        self.util = util
+        self.borrow_rate = borrow_rate
+        self.calc_obj = Calculations(top_k)
+        self.engine = self.calc_obj._resolve_engine(engine)
+        self.reprice_threshold = reprice_threshold
+        #Latest quote polled, and the one the rankings were calculated at.
+        self.stock_quote = None
+        self.priced_quote = None
+        self.expirations = []
+        self.expirations_fetched_at = None
+        self.chains = {}
+        self.fingerprints = {}
+        self.chains_fetched_at = {}
+        #Expiration date to (symmetric, asymmetric) partial rankings, see Calculations._merge_rankings.
+        self.partial_rankings = {}
+        self.stale = set()
+        self.computed_on = None
     
-    queries_obj = Queries(input['symbol'], tradier_sandbox_api_key)
-    options_data = queries_obj.gather_data()
+    def set_expirations(self, expirations: list, now: float) -> None:
+        self.expirations = expirations
+        self.expirations_fetched_at = now
+        for expiration_date in list(self.chains.keys()):
+            if expiration_date not in expirations:
+                for expiration_state in (self.chains, self.fingerprints, self.chains_fetched_at, self.partial_rankings):
+                    expiration_state.pop(expiration_date, None)
+                self.stale.discard(expiration_date)
     
-    #Debug text to help me track remaining API calls.
-    print('Debugging: thottling, api calls remaining: {0}'.format(queries_obj.ratelimit_available))
+    def set_quote(self, stock_quote: dict) -> bool:
+        """
+        Keep the latest quote. Returns whether the price the calculations use changed, which only happens once
+        the ask is more than reprice_threshold away from the price everything was last ranked at.
+        """
+        self.stock_quote = stock_quote
+        if self.priced_quote is not None:
+            priced_ask = to_decimal(self.priced_quote['ask'])
+            if abs(to_decimal(stock_quote['ask']) - priced_ask) <= priced_ask * self.reprice_threshold:
+                return False
+        self.priced_quote = stock_quote
+        self.stale.update(self.chains.keys())
+        return True
+    
+    def due_expirations(self, now: float, interval: float) -> list:
+        """
+        Expirations whose chain is due a refresh, nearest first. Near dated chains are due every poll,
+        later ones less often, see WATCH_REFRESH_TIERS.
+        """
+        today = date.today()
+        due = []
+        for expiration_date in sorted(self.expirations):
+            fetched_at = self.chains_fetched_at.get(expiration_date)
+            days_remaining = (date.fromisoformat(expiration_date) - today).days
+            tier = next((multiple for days, multiple in WATCH_REFRESH_TIERS if days_remaining <= days), WATCH_REFRESH_TIER_MAX)
+            if fetched_at is None or now - fetched_at >= interval * tier:
+                due.append(expiration_date)
+        return due
+    
+    def set_chain(self, expiration_date: str, option_chain: list, now: float) -> bool:
+        """
+        Store a freshly fetched chain. Returns whether any bid or ask moved since the last one.
+        """
+        self.chains_fetched_at[expiration_date] = now
+        fingerprint = hash(tuple((option['symbol'], option['bid'], option['ask']) for option in option_chain))
+        if fingerprint == self.fingerprints.get(expiration_date):
+            return False
+        self.fingerprints[expiration_date] = fingerprint
+        self.chains[expiration_date] = option_chain
+        self.stale.add(expiration_date)
+        return True
     
-    calc_obj = Calculations()
+    def recompute(self) -> int:
+        """
+        Re-rank the stale expirations. Returns how many were recomputed.
+        """
+        if self.priced_quote is None:
+            return 0
+        #Days remaining count down overnight.
+        if self.computed_on != date.today():
+            self.computed_on = date.today()
+            self.stale.update(self.chains.keys())
+        if not self.stale:
+            return 0
+        
+        calc_obj = self.calc_obj
+        prepared = PreparedChains({'stock_quote': self.priced_quote, 'as_of': datetime.now().isoformat(), 'options_data': []})
+        daily_payout_per_options_contract_before_fees = calc_obj.daily_payout(prepared, self.util, self.borrow_rate)
+        can_prune = calc_obj._can_prune()
+        recomputed = 0
+        for expiration_date in self.stale:
+            if expiration_date not in self.chains:
+                continue
+            expiration = prepared.prepare_expiration(expiration_date, self.chains[expiration_date])
+            symmetric_rankings = calc_obj._new_rankings()
+            asymmetric_rankings = calc_obj._new_rankings()
+            calc_obj._rank_symmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, symmetric_rankings)
+            calc_obj._rank_asymmetric_expiration(prepared, expiration, daily_payout_per_options_contract_before_fees, asymmetric_rankings, self.engine, can_prune)
+            self.partial_rankings[expiration_date] = (
+                [top_k.ranked() for top_k, _ in symmetric_rankings],
+                [top_k.ranked() for top_k, _ in asymmetric_rankings]
+            )
+            recomputed += 1
+        self.stale.clear()
+        return recomputed
     
-    #Output style patterns.
-    patterns = [
+    def rankings(self) -> tuple:
+        """
+        Merge the expirations' partial rankings into (calc_obj, symmetric rankings, asymmetric rankings) for display_rankings.
+        """
+        calc_obj = Calculations(self.calc_obj.top_k, self.calc_obj.rankings)
+        symmetric_rankings = calc_obj._new_rankings()
+        asymmetric_rankings = calc_obj._new_rankings()
+        #Expiration order, so ties rank the same as a one off run.
+        for expiration_date in self.expirations:
+            if expiration_date in self.partial_rankings:
+                symmetric_partial, asymmetric_partial = self.partial_rankings[expiration_date]
+                calc_obj._merge_rankings(symmetric_rankings, symmetric_partial)
+                calc_obj._merge_rankings(asymmetric_rankings, asymmetric_partial)
+        return (
+            calc_obj,
+            calc_obj._collect_rankings(symmetric_rankings, calc_obj.overall_data_symmetric),
+            calc_obj._collect_rankings(asymmetric_rankings, calc_obj.overall_data_asymmetric)
+        )
+
+
+def output_patterns() -> list:
+    """
+    Output style patterns for columnar. Colors only when printing to a terminal, CLI colors, pip install click
+    """
+    if not sys.stdout.isatty():
+        return []
+    from click import style
+    return [
         ('True', lambda text: style(text, fg='green')),
         ('itm', lambda text: style(text, fg='yellow')),
         ('otm', lambda text: style(text, fg='cyan')),
     ]
+
+def print_table(rows: list, headers: list, patterns: list = None) -> None:
+    """
+    Print rows as a borderless table. Pretty columns for CLI display, pip install columnar
+    """
+    if not rows:
+        #columnar won't take an empty table.
+        print('  None found.')
+        return
+    from columnar import columnar
+    print(columnar(rows, headers, no_borders=True, patterns=patterns or []))
+
+def top_trades(trades: dict, overall_data: TradeTable, count: int = TOP_K) -> tuple:
+    """
+    Pull the display rows for the best few of an already ranked trades dictionary.
+    Returns a tuple of (headers, rows).
+    """
+    rows = [format_trade(overall_data[key]) for key in list(trades.keys())[:count]]
+    return (list(TRADE_FIELDS), rows)
+
+def display_results(
+    options_data,
+    util: Decimal,
+    borrow_rate: Decimal,
+    processes: int = None,
+    report: RunReport = None,
+    top_k: int = TOP_K
+) -> dict:
+    """
+    Run both collar calculations for one symbol and print the top tables.
+    Returns a summary of the best trades, used to rank symbols against each other in batch mode.
+    """
+    calc_obj = Calculations(top_k, report=report)
+    #Merge the chains once for both calculations.
+    options_data = calc_obj._prepare(options_data)
     
-    #Symmetric output
     best_plays_output_symmetric = calc_obj.calculate_symmetric_collar(
         options_data = options_data,
-        util = input['util'],
-        borrow_rate = input['borrow_rate']
+        util = util,
+        borrow_rate = borrow_rate
     )
-    
-    risk_ascending_symmetric = OrderedDict(sorted(best_plays_output_symmetric[0].items(), key=lambda t: t[1]))
-    performance_ascending_symmetric = OrderedDict(sorted(best_plays_output_symmetric[1].items(), key=lambda t: t[1], reverse=True))
-    headers_sym = []
-    top_5_risk_sym = []
-    top_5_perform_sym = []
-    
-    risk_count = 0
-    for item in risk_ascending_symmetric.items():
-        top_5_risk_sym.append(list(calc_obj.overall_data_symmetric[item[0]].values()))
-        risk_count += 1
-        if risk_count == 5:
-            #Keys for column output are all the same, so populate it once.
-            headers_sym = list(calc_obj.overall_data_symmetric[item[0]].keys())
-            break
-    
-    profit_count = 0
-    for item in performance_ascending_symmetric.items():
-        top_5_perform_sym.append(list(calc_obj.overall_data_symmetric[item[0]].values()))
-        profit_count += 1
-        if profit_count == 5:
-            break
-    
-    print('Top 5 symettric collar trades by risk factor:')
-    print(columnar(top_5_risk_sym, headers_sym, no_borders=True, patterns=patterns))
-    print('Top 5 most profitable symettric collar trades:')
-    print(columnar(top_5_perform_sym, headers_sym, no_borders=True, patterns=patterns))
-    
-    #Asymmetric output
     best_plays_output_asymmetric = calc_obj.calculate_asymmetric_collar(
         options_data = options_data,
-        util = input['util'],
-        borrow_rate = input['borrow_rate']
+        util = util,
+        borrow_rate = borrow_rate,
+        processes = processes
     )
+    return display_rankings(calc_obj, options_data.symbol, best_plays_output_symmetric, best_plays_output_asymmetric)
+
+def display_rankings(calc_obj: Calculations, symbol: str, best_plays_output_symmetric: tuple, best_plays_output_asymmetric: tuple) -> dict:
+    """
+    Print the top tables from finished collar calculations.
+    Returns a summary of the best trades, used to rank symbols against each other in batch mode.
+    """
+    with report_stage(calc_obj.report, 'render'):
+        patterns = output_patterns()
+        
+        #Symmetric output
+        headers_sym, top_risk_sym = top_trades(best_plays_output_symmetric[0], calc_obj.overall_data_symmetric, calc_obj.top_k)
+        headers_sym, top_perform_sym = top_trades(best_plays_output_symmetric[1], calc_obj.overall_data_symmetric, calc_obj.top_k)
+        
+        print('Top {0} symettric collar trades by risk factor:'.format(calc_obj.top_k))
+        print_table(top_risk_sym, headers_sym, patterns)
+        print('Top {0} most profitable symettric collar trades:'.format(calc_obj.top_k))
+        print_table(top_perform_sym, headers_sym, patterns)
+        
+        #Asymmetric output
+        headers_asym, top_risk_asym = top_trades(best_plays_output_asymmetric[0], calc_obj.overall_data_asymmetric, calc_obj.top_k)
+        headers_asym, top_perform_asym = top_trades(best_plays_output_asymmetric[1], calc_obj.overall_data_asymmetric, calc_obj.top_k)
+        
+        print('Top {0} asymettric collar trades by risk factor:'.format(calc_obj.top_k))
+        print_table(top_risk_asym, headers_asym, patterns)
+        print('Top {0} most profitable asymettric collar trades:'.format(calc_obj.top_k))
+        print_table(top_perform_asym, headers_asym, patterns)
+    
+    return summarize_rankings(calc_obj, symbol, best_plays_output_symmetric, best_plays_output_asymmetric)
+
+def summarize_rankings(calc_obj: Calculations, symbol: str, best_plays_output_symmetric: tuple, best_plays_output_asymmetric: tuple) -> dict:
+    """
+    Summary of the best trades from finished collar calculations without printing anything.
+    Used to rank symbols against each other and for exports.
+    """
+    all_risk = list(best_plays_output_symmetric[0].values()) + list(best_plays_output_asymmetric[0].values())
+    all_profit = list(best_plays_output_symmetric[1].values()) + list(best_plays_output_asymmetric[1].values())
+    return {
+        'symbol': symbol,
+        'best_estimated_payout': max(all_profit) if all_profit else None,
+        'fewest_days_to_profit': min(all_risk) if all_risk else None,
+        #Every ranked trade per table, best first, for exporting.
+        'trades': [
+            (calc_obj.overall_data_symmetric, list(dict.fromkeys(key for trades in best_plays_output_symmetric for key in trades))),
+            (calc_obj.overall_data_asymmetric, list(dict.fromkeys(key for trades in best_plays_output_asymmetric for key in trades)))
+        ]
+    }
+
+def display_sensitivity(options_data, utils: list, borrow_rates: list, report: RunReport = None) -> None:
+    """
+    Print the best payout and fewest days to profit for every (util, borrow_rate) scenario.
+    """
+    scenarios = Calculations(report=report).sensitivity_table(options_data, utils, borrow_rates)
+    payout_index = TRADE_FIELDS.index('estimated_payout')
+    days_index = TRADE_FIELDS.index('days_to_profit')
+    rows = []
+    for scenario in scenarios:
+        #Rankings come back in RANKINGS order, risk then profit.
+        row = ['{0:.2f}%'.format(scenario['util'] * 100), '{0:.2f}%'.format(scenario['borrow_rate'] * 100)]
+        for collar_type in ('symmetric', 'asymmetric'):
+            best_risk, best_profit = scenario[collar_type]
+            row.append('${0:.2f}'.format(best_profit[payout_index]) if best_profit else '')
+            row.append(best_risk[days_index] if best_risk else '')
+        rows.append(row)
+    headers = ['util', 'borrow_rate', 'symmetric_best_payout', 'symmetric_fewest_days', 'asymmetric_best_payout', 'asymmetric_fewest_days']
+    with report_stage(report, 'render'):
+        print('Sensitivity by utilization and borrow rate:')
+        print_table(rows, headers)
+
+def write_trades(stream, export_tables: list, output_format: str) -> None:
+    """
+    Write (symbol, TradeTable, keys) tables to a text stream as 'csv', 'jsonl' for JSON Lines or 'json'.
+    """
+    export_rows = (export_row for symbol, table, keys in export_tables for export_row in table.export_rows(symbol, keys))
+    if output_format == 'csv':
+        writer = csv.DictWriter(stream, ['symbol', 'collar', 'key'] + [name for name, _ in TRADE_COLUMNS])
+        writer.writeheader()
+        writer.writerows(export_rows)
+    elif output_format == 'jsonl':
+        for export_row in export_rows:
+            stream.write(json.dumps(export_row) + '\n')
+    elif output_format == 'json':
+        json.dump(list(export_rows), stream)
+        stream.write('\n')
+    else:
+        raise Exception('Problem writing trades. Unknown output format {0}.'.format(output_format))
+
+def export_trades(export_file: str, summaries: list) -> None:
+    """
+    Write every ranked trade from display_rankings summaries with raw numbers, no '$' or '%' to parse.
+    The format goes by extension: .csv, .jsonl for JSON Lines, .json, anything else gets the binary columnar format.
+    """
+    export_tables = [(summary['symbol'], table, keys) for summary in summaries for table, keys in summary['trades']]
+    suffix = Path(export_file).suffix.lower()
+    if suffix in ('.csv', '.jsonl', '.json'):
+        with open(export_file, 'w', newline='') as export:
+            write_trades(export, export_tables, suffix[1:])
+    else:
+        write_trades_columnar(export_file, export_tables)
+
+def write_trades_columnar(export_file: str, export_tables: list) -> None:
+    """
+    Binary columnar export of (symbol, TradeTable, keys) tables, one column after another.
+    Layout: COLUMNAR_MAGIC, a little endian uint32 header length, a UTF-8 JSON header of
+    {'rows', 'byteorder', 'columns': [{'name', 'type', 'bytes'}]}, then each column's bytes in header order.
+    Numeric columns are raw arrays of their TRADE_COLUMNS typecode (numpy.frombuffer reads them as is),
+    and the symbol, collar and key columns are UTF-8 strings joined by newlines.
+    """
+    text_columns = {'symbol': [], 'collar': [], 'key': []}
+    numeric_columns = {name: array(typecode) for name, typecode in TRADE_COLUMNS}
+    for symbol, table, keys in export_tables:
+        rows = [table._rows[key] for key in keys]
+        text_columns['symbol'].extend([symbol] * len(rows))
+        text_columns['collar'].extend([table.collar] * len(rows))
+        text_columns['key'].extend(keys)
+        for name, column in numeric_columns.items():
+            column.extend(table.columns[name][row] for row in rows)
+    
+    column_bytes = [(name, 'str', '\n'.join(values).encode('utf-8')) for name, values in text_columns.items()]
+    column_bytes.extend((name, column.typecode, column.tobytes()) for name, column in numeric_columns.items())
+    header = json.dumps({
+        'rows': len(text_columns['key']),
+        'byteorder': sys.byteorder,
+        'columns': [{'name': name, 'type': column_type, 'bytes': len(data)} for name, column_type, data in column_bytes]
+    }).encode('utf-8')
+    with open(export_file, 'wb') as export:
+        export.write(COLUMNAR_MAGIC)
+        export.write(struct.pack('<I', len(header)))
+        export.write(header)
+        for _, _, data in column_bytes:
+            export.write(data)
+
+def read_trades_columnar(export_file: str) -> dict:
+    """
+    Load a binary columnar export back into a dictionary of column name to array (or list of strings).
+    """
+    with open(export_file, 'rb') as export:
+        if export.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise Exception('Problem reading {0}, not a columnar trade export.'.format(export_file))
+        header_length, = struct.unpack('<I', export.read(4))
+        header = json.loads(export.read(header_length).decode('utf-8'))
+        columns = {}
+        for column in header['columns']:
+            data = export.read(column['bytes'])
+            if column['type'] == 'str':
+                columns[column['name']] = data.decode('utf-8').split('\n') if header['rows'] else []
+            else:
+                values = array(column['type'])
+                values.frombytes(data)
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+                columns[column['name']] = values
+    return columns
+
+def parse_percentage(percentage: str) -> Decimal:
+    """
+    One percentage from the command line, as a fraction.
+    """
+    try:
+        return Decimal(percentage.strip()) / 100
+    except ArithmeticError:
+        raise argparse.ArgumentTypeError('Problem reading percentage {0}.'.format(percentage))
+
+def parse_percentages(percentages: str) -> list:
+    """
+    Comma separated percentages from the command line, as fractions.
+    """
+    return [parse_percentage(percentage) for percentage in percentages.split(',') if percentage.strip()]
+
+def run_single(
+    api_key: str,
+    cache: ChainCache = None,
+    snapshot_file: str = None,
+    sweep_utils: list = None,
+    sweep_borrow_rates: list = None,
+    processes: int = None,
+    report: RunReport = None,
+    export_file: str = None,
+    top_k: int = TOP_K
+) -> None:
+    """
+    Interactive lookup of one symbol. Optionally saves what was gathered as a snapshot for later replay,
+    and exports the ranked trades.
+    """
+    input_data = input_section()
+    queries_obj = Queries(input_data['symbol'], api_key, cache=cache, report=report)
+    
+    #Snapshots, sweeps and the process pool need every chain kept around, otherwise calculate each chain as it lands.
+    if not snapshot_file and not (sweep_utils or sweep_borrow_rates) and not processes:
+        print('Grabbing current stock price and options expirations.')
+        stock_quote, expirations = queries_obj.quote_and_expirations()
+        calc_obj = Calculations(top_k, report=report)
+        best_plays_output = ({}, {})
+        for _, symmetric_output, asymmetric_output in progress(
+            calc_obj.stream_collars(stock_quote, queries_obj.iter_chains(expirations), input_data['util'], input_data['borrow_rate'], expirations=expirations),
+            total=len(expirations)
+        ):
+            best_plays_output = (symmetric_output, asymmetric_output)
+        queries_obj.close()
+        
+        #Debug text to help me track remaining API calls.
+        print('Debugging: thottling, api calls remaining: {0}'.format(queries_obj.ratelimit_available))
+        
+        summary = display_rankings(calc_obj, stock_quote['symbol'], *best_plays_output)
+        if export_file:
+            export_trades(export_file, [summary])
+        return
+    
+    options_data = queries_obj.gather_data()
+    queries_obj.close()
+    
+    #Debug text to help me track remaining API calls.
+    print('Debugging: thottling, api calls remaining: {0}'.format(queries_obj.ratelimit_available))
+    
+    if snapshot_file:
+        save_snapshot(options_data, snapshot_file)
+    
+    with report_stage(report, 'chain_merge'):
+        prepared = PreparedChains(options_data)
+    summary = display_results(prepared, input_data['util'], input_data['borrow_rate'], processes=processes, report=report, top_k=top_k)
+    if sweep_utils or sweep_borrow_rates:
+        display_sensitivity(prepared, sweep_utils or [input_data['util']], sweep_borrow_rates or [input_data['borrow_rate']], report=report)
+    if export_file:
+        export_trades(export_file, [summary])
+
+def run_replay(
+    snapshot_file: str,
+    sweep_utils: list = None,
+    sweep_borrow_rates: list = None,
+    processes: int = None,
+    report: RunReport = None,
+    export_file: str = None,
+    top_k: int = TOP_K,
+    util: Decimal = None,
+    borrow_rate: Decimal = None,
+    output_format: str = 'table'
+) -> None:
+    """
+    Re-run the calculations against a saved snapshot with no network at all.
+    Prompts for the utilization and borrow rate unless both are given. Output formats work like run_scan.
+    """
+    show_tables = output_format == 'table'
+    if (sweep_utils or sweep_borrow_rates) and not show_tables:
+        raise Exception('Problem running sweeps. Sensitivity tables only print with output format table.')
+    output = sys.stdout
+    
+    #Keep stdout clean for the trades when writing a machine readable format.
+    with nullcontext() if show_tables else redirect_stdout(sys.stderr):
+        options_data = load_snapshot(snapshot_file)
+        print('Replaying {0} snapshot taken {1}.'.format(options_data['stock_quote']['symbol'], options_data.get('as_of', 'at an unknown time')))
+        if util is None or borrow_rate is None:
+            input_data = input_section(ask_symbol=False)
+            util, borrow_rate = input_data['util'], input_data['borrow_rate']
+        
+        with report_stage(report, 'chain_merge'):
+            prepared = PreparedChains(options_data)
+        if show_tables:
+            summary = display_results(prepared, util, borrow_rate, processes=processes, report=report, top_k=top_k)
+        else:
+            calc_obj = Calculations(top_k, report=report)
+            summary = summarize_rankings(
+                calc_obj,
+                prepared.symbol,
+                calc_obj.calculate_symmetric_collar(prepared, util, borrow_rate),
+                calc_obj.calculate_asymmetric_collar(prepared, util, borrow_rate, processes=processes)
+            )
+    if sweep_utils or sweep_borrow_rates:
+        display_sensitivity(prepared, sweep_utils or [util], sweep_borrow_rates or [borrow_rate], report=report)
+    if not show_tables:
+        with report_stage(report, 'render'):
+            write_trades(output, [(summary['symbol'], table, keys) for table, keys in summary['trades']], output_format)
+    if export_file:
+        export_trades(export_file, [summary])
+
+def run_scan(
+    api_key: str,
+    scan_rows: list,
+    cache: ChainCache = None,
+    processes: int = None,
+    report: RunReport = None,
+    export_file: str = None,
+    output_format: str = 'table',
+    top_k: int = TOP_K,
+    snapshot_file: str = None,
+    sweep_utils: list = None,
+    sweep_borrow_rates: list = None
+) -> list:
+    """
+    Scan symbols without any prompts. scan_rows are dicts of symbol, util and borrow_rate like batch_input_section returns.
+    With output_format 'table' results print per symbol as its chains come in, then several symbols get ranked
+    by best estimated payout. With 'csv', 'jsonl' or 'json' every ranked trade goes to stdout in that format instead
+    and status messages go to stderr, so the output can be piped or redirected from cron.
+    With processes > 1 each symbol is calculated in a process pool while the next ones download, a single symbol
+    spreads its expirations over the pool instead. Returns the per symbol summaries.
+    snapshot_file saves what was gathered for a single symbol. Sweeps print a sensitivity table per symbol
+    after its top tables, so they only go with output_format 'table'.
+    """
+    inputs_by_symbol = {row['symbol']: row for row in scan_rows}
+    show_tables = output_format == 'table'
+    sweeping = bool(sweep_utils or sweep_borrow_rates)
+    if snapshot_file and len(inputs_by_symbol) > 1:
+        raise Exception('Problem saving snapshot. A snapshot holds one symbol, got {0}.'.format(len(inputs_by_symbol)))
+    if sweeping and not show_tables:
+        raise Exception('Problem running sweeps. Sensitivity tables only print with output format table.')
+    output = sys.stdout
+    summaries = []
+    
+    def gathered():
+        """
+        Each symbol's chains, prepared as they come in so raw chains aren't held. A snapshot needs the raw
+        chains, so with snapshot_file they're kept until the symbol is saved and prepared then.
+        """
+        if not snapshot_file:
+            for symbol, prepared in queries_obj.gather_batch(list(inputs_by_symbol.keys()), prepare=True):
+                yield (inputs_by_symbol[symbol], prepared)
+            return
+        for symbol, options_data in queries_obj.gather_batch(list(inputs_by_symbol.keys())):
+            save_snapshot(options_data, snapshot_file)
+            with report_stage(report, 'chain_merge'):
+                prepared = PreparedChains(options_data)
+            yield (inputs_by_symbol[symbol], prepared)
+    
+    def finish(result: tuple, prepared: PreparedChains = None) -> None:
+        """Collect one calculated symbol, printing its tables when showing them."""
+        calc_obj, symbol, best_plays_output_symmetric, best_plays_output_asymmetric = result
+        if report:
+            report.merge(calc_obj.report)
+            calc_obj.report = report
+        if show_tables:
+            print('===== {0} ====='.format(symbol))
+            summaries.append(display_rankings(calc_obj, symbol, best_plays_output_symmetric, best_plays_output_asymmetric))
+        else:
+            summaries.append(summarize_rankings(calc_obj, symbol, best_plays_output_symmetric, best_plays_output_asymmetric))
+        if sweeping:
+            row = inputs_by_symbol[symbol]
+            display_sensitivity(prepared, sweep_utils or [row['util']], sweep_borrow_rates or [row['borrow_rate']], report=report)
     
-    risk_ascending_asymmetric = OrderedDict(sorted(best_plays_output_asymmetric[0].items(), key=lambda t: t[1]))
-    performance_ascending_asymmetric = OrderedDict(sorted(best_plays_output_asymmetric[1].items(), key=lambda t: t[1], reverse=True))
-    headers_asym = []
-    top_5_risk_asym = []
-    top_5_perform_asym = []
-    
-    risk_count = 0
-    for item in risk_ascending_asymmetric.items():
-        top_5_risk_asym.append(list(calc_obj.overall_data_asymmetric[item[0]].values()))
-        risk_count += 1
-        if risk_count == 5:
-            #Keys for column output are all the same, so populate it once.
-            headers_asym = list(calc_obj.overall_data_asymmetric[item[0]].keys())
-            break
-    
-    profit_count = 0
-    for item in performance_ascending_asymmetric.items():
-        top_5_perform_asym.append(list(calc_obj.overall_data_asymmetric[item[0]].values()))
-        profit_count += 1
-        if profit_count == 5:
-            break
-    
-    print('Top 5 asymettric collar trades by risk factor:')
-    print(columnar(top_5_risk_asym, headers_asym, no_borders=True, patterns=patterns))
-    print('Top 5 most profitable asymettric collar trades:')
-    print(columnar(top_5_perform_asym, headers_asym, no_borders=True, patterns=patterns))
\ No newline at end of file
+    #Keep stdout clean for the trades when writing a machine readable format.
+    with nullcontext() if show_tables else redirect_stdout(sys.stderr):
+        queries_obj = Queries(None, api_key, cache=cache, report=report)
+        if processes and processes > 1 and len(inputs_by_symbol) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            
+            def finish_done(futures: dict) -> dict:
+                """Collect whichever symbols are done, return the ones still running."""
+                running = {}
+                for future, prepared in futures.items():
+                    if not future.done():
+                        running[future] = prepared
+                        continue
+                    finish(future.result(), prepared)
+                return running
+            
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                #Running futures, with their prepared chains kept back for the sweeps.
+                futures = {}
+                for row, prepared in gathered():
+                    #Workers only get the prepared sides and symmetric collars, not every raw chain field.
+                    future = executor.submit(calculate_symbol, prepared, row['util'], row['borrow_rate'], bool(report), top_k)
+                    futures[future] = prepared if sweeping else None
+                    futures = finish_done(futures)
+                wait(futures)
+                finish_done(futures)
+        else:
+            for row, prepared in gathered():
+                finish(calculate_symbol(prepared, row['util'], row['borrow_rate'], bool(report), top_k, processes), prepared)
+        queries_obj.close()
+        
+        print('Debugging: thottling, api calls remaining: {0}'.format(queries_obj.ratelimit_available))
+    
+    if show_tables and len(inputs_by_symbol) > 1:
+        ranked = sorted(
+            (summary for summary in summaries if summary['best_estimated_payout'] is not None),
+            key=lambda summary: summary['best_estimated_payout'],
+            reverse=True
+        )
+        ranked_rows = [[
+            summary['symbol'],
+            '${0}'.format(round(summary['best_estimated_payout'], 2)),
+            summary['fewest_days_to_profit']
+        ] for summary in ranked]
+        with report_stage(report, 'render'):
+            print('Symbols ranked by best estimated payout:')
+            print_table(ranked_rows, ['symbol', 'best_estimated_payout', 'fewest_days_to_profit'])
+    elif not show_tables:
+        with report_stage(report, 'render'):
+            write_trades(output, [(summary['symbol'], table, keys) for summary in summaries for table, keys in summary['trades']], output_format)
+    if export_file:
+        export_trades(export_file, summaries)
+    return summaries
+
+def run_watch(
+    api_key: str,
+    watch_rows: list,
+    interval: float,
+    expirations_interval: float = WATCH_EXPIRATIONS_SECONDS,
+    max_chains: int = None,
+    report: RunReport = None,
+    cycles: int = None,
+    top_k: int = TOP_K
+) -> None:
+    """
+    Keep watching symbols, redrawing the top tables every interval seconds until interrupted.
+    watch_rows are dicts of symbol, util and borrow_rate like batch_input_section returns.
+    Each refresh polls every quote in one call, re-lists expirations every expirations_interval seconds and
+    re-fetches at most max_chains due chains, nearest expirations first. Only expirations whose chain changed get
+    recomputed, or every one once the stock moves past WATCH_REPRICE_THRESHOLD. max_chains defaults to half the API budget for one interval.
+    """
+    from click import clear
+    
+    if max_chains is None:
+        max_chains = max(int(RATELIMIT_CALLS_PER_MINUTE * interval / 60 / 2), 1)
+    queries_obj = Queries(None, api_key, report=report)
+    watches = {row['symbol']: CollarWatch(row['symbol'], row['util'], row['borrow_rate'], top_k) for row in watch_rows}
+    cycle = 0
+    try:
+        while cycles is None or cycle < cycles:
+            cycle_started = time()
+            try:
+                quotes_by_symbol = queries_obj.batch_quotes(list(watches.keys()))
+                #Printed after the redraw, anything printed before it gets cleared.
+                skipped = []
+                with ThreadPoolExecutor(max_workers=queries_obj.max_workers) as executor:
+                    futures = {}
+                    for symbol, watch in watches.items():
+                        if symbol not in quotes_by_symbol:
+                            continue
+                        watch.set_quote(quotes_by_symbol[symbol])
+                        if watch.expirations_fetched_at is None or cycle_started - watch.expirations_fetched_at >= expirations_interval:
+                            futures[executor.submit(queries_obj.expirations, symbol)] = symbol
+                    for future in as_completed(futures):
+                        symbol = futures[future]
+                        try:
+                            watches[symbol].set_expirations(future.result(), cycle_started)
+                        except Exception as e:
+                            #Names without listed options come back empty, so one symbol can't hold up the rest.
+                            #Its held chains stay and the expirations get retried at the next re-list.
+                            watches[symbol].expirations_fetched_at = cycle_started
+                            skipped.append('Skipping {0}: {1}'.format(symbol, e))
+                    
+                    #Chains never fetched come first, then the nearest expirations across every symbol,
+                    #capped so one refresh stays inside the budget.
+                    due = sorted(
+                        (expiration_date in watch.chains_fetched_at, expiration_date, symbol)
+                        for symbol, watch in watches.items()
+                        for expiration_date in watch.due_expirations(cycle_started, interval)
+                    )[:max_chains]
+                    changed = 0
+                    futures = {executor.submit(queries_obj.options_chain, expiration_date, symbol): (symbol, expiration_date) for _, expiration_date, symbol in due}
+                    for future in as_completed(futures):
+                        symbol, expiration_date = futures[future]
+                        try:
+                            changed += watches[symbol].set_chain(expiration_date, future.result(), cycle_started)
+                        except Exception as e:
+                            skipped.append('Skipping {0} {1}: {2}'.format(symbol, expiration_date, e))
+                recomputed = sum(watch.recompute() for watch in watches.values())
+                
+                #Redraw over the last refresh.
+                clear()
+                print('{0} refreshed {1} chains, {2} changed, {3} expirations recomputed. API calls remaining: {4}'.format(
+                    datetime.now().strftime('%H:%M:%S'), len(due), changed, recomputed, queries_obj.ratelimit_available
+                ))
+                for message in skipped:
+                    print(message)
+                for symbol, watch in watches.items():
+                    if watch.stock_quote is None:
+                        print('===== {0}: no quote ====='.format(symbol))
+                        continue
+                    if not watch.chains:
+                        #Refreshes are capped by max_chains, so with many symbols some wait a few rounds.
+                        print('===== {0} ${1}: no chains yet ====='.format(symbol, watch.stock_quote['ask']))
+                        continue
+                    if watch.priced_quote['ask'] != watch.stock_quote['ask']:
+                        print('===== {0} ${1}, ranked at ${2} ====='.format(symbol, watch.stock_quote['ask'], watch.priced_quote['ask']))
+                    else:
+                        print('===== {0} ${1} ====='.format(symbol, watch.stock_quote['ask']))
+                    calc_obj, best_plays_output_symmetric, best_plays_output_asymmetric = watch.rankings()
+                    calc_obj.report = report
+                    display_rankings(calc_obj, symbol, best_plays_output_symmetric, best_plays_output_asymmetric)
+            except Exception as e:
+                #A blip shouldn't end the session, the next refresh tries again.
+                print('Refresh failed: {0}'.format(e))
+            
+            cycle += 1
+            if cycles is None or cycle < cycles:
+                sleep(max(interval - (time() - cycle_started), 0))
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        queries_obj.close()
+
+
+def main(argv: list = None) -> None:
+    """
+    Command line entry point. Prompts for one symbol, or runs with no prompts given --symbol or a screener file.
+    """
+    parser = argparse.ArgumentParser(description='Find loan fee arbitrage collars.')
+    #Pass a screener file to scan many symbols at once, otherwise prompt for one.
+    parser.add_argument('batch_file', nargs='?', help='Screener file of symbol,util,borrow_rate rows.')
+    parser.add_argument('--symbol', nargs='+', help='Scan these symbols without prompting, needs --util and --borrow-rate.')
+    parser.add_argument('--util', type=parse_percentage, help='Utilization rate percentage for --symbol or --replay.')
+    parser.add_argument('--borrow-rate', type=parse_percentage, help='Borrow rate percentage for --symbol or --replay.')
+    parser.add_argument('--format', choices=['table', 'csv', 'jsonl', 'json'], default='table', help='Print tables, or every ranked trade to stdout for scripts. Needs --symbol, a screener file or --replay.')
+    parser.add_argument('--top-k', type=int, default=TOP_K, help='Trades kept per ranking.')
+    parser.add_argument('--cache-ttl', type=float, help='Reuse Tradier responses cached within this many seconds.')
+    parser.add_argument('--offline', action='store_true', help='Only use cached responses, never touch the network.')
+    parser.add_argument('--save-snapshot', help='Save the gathered data for the symbol to this file.')
+    parser.add_argument('--replay', help='Run the calculations against a saved snapshot file, no network.')
+    parser.add_argument('--sweep-utils', type=parse_percentages, help='Comma separated utilization percentages for a sensitivity table.')
+    parser.add_argument('--sweep-borrow-rates', type=parse_percentages, help='Comma separated borrow rate percentages for a sensitivity table.')
+    parser.add_argument('--processes', type=int, help='Calculate symbols in this many processes while the next ones download, for screener files or several --symbol.')
+    parser.add_argument('--report', help='Write a JSON run report with stage timings, API usage and candidate counts to this file.')
+    parser.add_argument('--watch', type=float, help='Keep running and refresh the tables every this many seconds, only re-fetching chains that are due.')
+    parser.add_argument('--watch-expirations', type=float, default=WATCH_EXPIRATIONS_SECONDS, help='Seconds between expiration list refreshes in watch mode.')
+    parser.add_argument('--export', help='Save the ranked trades to this file, .csv, .jsonl, .json or anything else for binary columnar.')
+    parser.add_argument('--profile', help='Run under cProfile and save the stats to this file, the slowest functions also go in the report.')
+    args = parser.parse_args(argv)
+    
+    if args.symbol and (args.util is None or args.borrow_rate is None):
+        parser.error('--symbol needs --util and --borrow-rate.')
+    if (args.util is not None or args.borrow_rate is not None) and not (args.symbol or args.replay):
+        parser.error('--util and --borrow-rate go with --symbol or --replay, a screener file has its own per row.')
+    if args.replay and (args.util is None) != (args.borrow_rate is None):
+        parser.error('--replay needs both --util and --borrow-rate, or neither to be prompted.')
+    if args.symbol and (args.batch_file or args.replay):
+        parser.error('--symbol can not be combined with a screener file or --replay.')
+    if args.replay and (args.batch_file or args.save_snapshot):
+        parser.error('--replay can not be combined with a screener file or --save-snapshot.')
+    if args.format != 'table' and (args.watch or not (args.symbol or args.batch_file or args.replay)):
+        parser.error('--format {0} needs --symbol, a screener file or --replay, and does not work with --watch.'.format(args.format))
+    if args.format != 'table' and args.replay and args.util is None:
+        parser.error('--format {0} with --replay needs --util and --borrow-rate, there is no one to prompt.'.format(args.format))
+    if args.format != 'table' and (args.sweep_utils or args.sweep_borrow_rates):
+        parser.error('Sensitivity sweeps print tables, they need --format table.')
+    if args.watch and (args.replay or args.offline or args.cache_ttl is not None or args.export or args.processes or args.save_snapshot or args.sweep_utils or args.sweep_borrow_rates):
+        #Watch mode keeps its own chains in memory and only redraws the top tables.
+        parser.error('--watch can not be combined with --replay, --offline, --cache-ttl, --export, --processes, --save-snapshot or sweeps.')
+    if args.top_k < 1:
+        parser.error('--top-k must be at least 1.')
+    if args.processes and not (args.batch_file or (args.symbol and len(args.symbol) > 1)):
+        #One symbol's pruned search is faster than starting the pool, see Calculations.calculate_asymmetric_collar.
+        parser.error('--processes spreads symbols over processes, it needs a screener file or several --symbol.')
+    
+    scan_rows = None
+    if args.symbol:
+        scan_rows = [{
+            'symbol': symbol.upper().replace(' ','').replace('$', ''),
+            'util': args.util,
+            'borrow_rate': args.borrow_rate
+        } for symbol in args.symbol]
+    elif args.batch_file:
+        scan_rows = batch_input_section(args.batch_file)
+    if args.save_snapshot and scan_rows is not None and len(scan_rows) > 1:
+        parser.error('--save-snapshot saves one symbol, got {0}.'.format(len(scan_rows)))
+    
+    report = RunReport() if args.report else None
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.replay:
+            run_replay(
+                args.replay,
+                sweep_utils=args.sweep_utils,
+                sweep_borrow_rates=args.sweep_borrow_rates,
+                processes=args.processes,
+                report=report,
+                export_file=args.export,
+                top_k=args.top_k,
+                util=args.util,
+                borrow_rate=args.borrow_rate,
+                output_format=args.format
+            )
+        else:
+            cache = None
+            if args.cache_ttl is not None or args.offline:
+                cache = ChainCache(ttl=args.cache_ttl or 0, offline=args.offline)
+            tradier_sandbox_api_key = None if args.offline else tradier_key()
+            
+            if args.watch:
+                run_watch(tradier_sandbox_api_key, scan_rows or [input_section()], args.watch, expirations_interval=args.watch_expirations, report=report, top_k=args.top_k)
+            elif scan_rows is not None:
+                run_scan(
+                    tradier_sandbox_api_key,
+                    scan_rows,
+                    cache=cache,
+                    processes=args.processes,
+                    report=report,
+                    export_file=args.export,
+                    output_format=args.format,
+                    top_k=args.top_k,
+                    snapshot_file=args.save_snapshot,
+                    sweep_utils=args.sweep_utils,
+                    sweep_borrow_rates=args.sweep_borrow_rates
+                )
+            else:
+                run_single(
+                    tradier_sandbox_api_key,
+                    cache=cache,
+                    snapshot_file=args.save_snapshot,
+                    sweep_utils=args.sweep_utils,
+                    sweep_borrow_rates=args.sweep_borrow_rates,
+                    processes=args.processes,
+                    report=report,
+                    export_file=args.export,
+                    top_k=args.top_k
+                )
+    finally:
+        #Still write out whatever was recorded when a run fails, that's when it's needed most.
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if report:
+            if profiler:
+                report.add_profile(profiler, args.profile)
+            report.save(args.report)
+
+
+if __name__ == '__main__':
+    main()